@@ -0,0 +1,295 @@
+"""Микробенчмарки функций на горячем пути бота.
+
+Замеряет маршрутизацию handle_message, validate_date/validate_name, сборку
+клавиатур и функции БД (save_submission, get_submissions_by_date,
+get_submissions_page, get_user_setting) на базах с 10 тыс., 100 тыс.
+и 1 млн заявок. VK API заменяется заглушкой, база создаётся во временной папке.
+
+Результаты сохраняются в JSON, чтобы сравнивать версии между собой:
+
+    python benchmarks.py --output bench_new.json
+    python benchmarks.py --sizes 10000 --compare bench_old.json
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+REGRESSION_THRESHOLD = 1.25  # замедление больше чем на 25% считается регрессией
+NOISE_FLOOR_US = 5  # разница меньше нескольких микросекунд - шум измерений
+# Запросы, которые должны брать и отбор, и порядок строк из индекса
+INDEX_ORDERED_QUERIES = ('get_submissions_by_date', 'get_submissions_page', 'export')
+
+class StubMethod:
+    """Заглушка VK API: vk.messages.send(...), vk.users.get(...)"""
+
+    def __init__(self, name=''):
+        self.name = name
+
+    def __getattr__(self, item):
+        return StubMethod(f'{self.name}.{item}'.lstrip('.'))
+
+    def __call__(self, **params):
+        if self.name == 'users.get':
+            return [{'id': int(uid), 'first_name': 'Тест', 'last_name': 'Тестов'}
+                    for uid in str(params['user_ids']).split(',')]
+        return 1
+
+def load_bot(workdir):
+    """Импорт bot.py с базой во временной папке и заглушкой VK"""
+    os.environ.setdefault('VK_TOKEN', 'benchmark')
+    os.environ.setdefault('VK_GROUP_ID', '1')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    import bot
+    # Логи на каждую заявку замеряли бы вывод в терминал, а не сам код
+    logging.getLogger('bot').setLevel(logging.WARNING)
+    bot.vk = StubMethod()
+    bot.vk_scheduler = None
+    return bot
+
+def measure(func, iterations, warmup=10):
+    """Время вызовов func() в микросекундах: среднее, p50, p95"""
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter_ns()
+        func()
+        samples.append((time.perf_counter_ns() - started) / 1000)
+    samples.sort()
+    mean = sum(samples) / len(samples)
+    return {
+        'iterations': iterations,
+        'mean_us': round(mean, 2),
+        'p50_us': round(samples[len(samples) // 2], 2),
+        'p95_us': round(samples[int(len(samples) * 0.95) - 1], 2),
+        'ops_per_s': round(1e6 / mean, 1) if mean else 0.0
+    }
+
+def seed(bot, total_rows, current_rows):
+    """Добавление заявок и настроек до total_rows строк (даты - за последний год)"""
+    today = datetime.date.today()
+
+    def rows():
+        # Генератор: при миллионе заявок список кортежей занял бы сотни мегабайт
+        for i in range(current_rows, total_rows):
+            stage_date = today - datetime.timedelta(days=i % 365)
+            yield (100000 + i % 50000, 'Тест Тестов', bot.GROUPS[i % len(bot.GROUPS)],
+                   stage_date.strftime('%d.%m.%Y'), stage_date.isoformat(),
+                   f'Ребёнок {i}', f'video-1_{i}')
+    settings = ((100000 + i, i % 5 != 0) for i in range(current_rows // 10, total_rows // 10))
+    with bot.db.write_lock() as conn:
+        conn.executemany('''
+            INSERT INTO submissions (user_id, user_name, group_name, date, date_iso, child_name, video_attachment)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', rows())
+        conn.executemany('''
+            INSERT INTO user_settings (user_id, use_bot) VALUES (?, ?)
+            ON CONFLICT(user_id) DO NOTHING
+        ''', settings)
+        conn.commit()
+
+def query_plan(bot, sql, params):
+    """План запроса: по нему видно, что индекс перестал использоваться"""
+    with bot.db.reader() as conn:
+        return [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+
+def query_plans(bot):
+    """Планы запросов, которые выполняет бот: SQL берётся из тех же функций, что и в bot.py"""
+    today = datetime.date.today()
+    week_ago = today - datetime.timedelta(days=7)
+    probe_date, week_ago_text = today.strftime('%d.%m.%Y'), week_ago.strftime('%d.%m.%Y')
+    export_sql, export_params = bot.export_query(week_ago.isoformat(), today.isoformat())
+    return {
+        'get_submissions_by_date': query_plan(bot, *bot.submissions_by_date_query(probe_date)),
+        'get_submissions_page': query_plan(bot, *bot.submissions_page_query(
+            probe_date, probe_date, after=['2000-01-01 00:00:00', 0])),
+        # За период порядок (created_at, id) из индекса по дате не получить - только сравнение
+        'get_submissions_page.week': query_plan(bot, *bot.submissions_page_query(
+            week_ago_text, probe_date, after=['2000-01-01 00:00:00', 0])),
+        'export': query_plan(bot, export_sql, [0] + export_params + [bot.EXPORT_PAGE_SIZE]),
+    }
+
+def check_plans(plans):
+    """Запросы по дате и выгрузка: поиск по индексу и порядок строк из него же"""
+    problems = []
+    for name in INDEX_ORDERED_QUERIES:
+        plan = plans[name]
+        if not plan[0].startswith('SEARCH submissions USING'):
+            problems.append(f'{name}: поиск без индекса: {plan}')
+        if any('TEMP B-TREE' in step for step in plan):
+            problems.append(f'{name}: сортировка без индекса: {plan}')
+    return problems
+
+def bench_cpu(bot, iterations):
+    """Бенчмарки без БД: маршрутизация, валидация, клавиатуры"""
+    results = {}
+    user_id = 42
+    bot.set_user_setting(user_id, True)
+
+    def dispatch_invalid_date():
+        with bot.state_lock:
+            bot.user_states[user_id] = {'state': bot.UserState.PARENT_ENTER_DATE, 'group': 'Земля'}
+        bot.handle_message(user_id, 'не дата', [], {'first_name': 'Тест', 'last_name': 'Тестов'})
+
+    def dispatch_settings():
+        with bot.state_lock:
+            bot.user_states[user_id] = {'state': bot.UserState.CHOOSE_ROLE}
+        bot.handle_message(user_id, '⚙️ Настройки', [], {'first_name': 'Тест', 'last_name': 'Тестов'})
+
+    results['handle_message.invalid_date'] = measure(dispatch_invalid_date, iterations)
+    results['handle_message.settings'] = measure(dispatch_settings, iterations)
+    results['route_message'] = measure(
+        lambda: bot.route_message(bot.UserState.PARENT_ENTER_NAME, 'иван иванов'), iterations * 10)
+    results['validate_date'] = measure(lambda: bot.validate_date('01.12.2025'), iterations * 10)
+    results['validate_name'] = measure(lambda: bot.validate_name('Иван Иванов'), iterations * 10)
+    results['create_groups_keyboard'] = measure(bot.create_groups_keyboard, iterations)
+    results['create_role_keyboard'] = measure(bot.create_role_keyboard, iterations)
+    return results
+
+def bench_db(bot, rows, iterations):
+    """Бенчмарки функций БД на базе с rows заявками"""
+    results = {}
+    probe_date = datetime.date.today().strftime('%d.%m.%Y')
+    counter = iter(range(10 ** 9))
+
+    def save():
+        i = next(counter)
+        bot.save_submission(700000 + i, 'Тест', 'Земля', probe_date, 'Тестовый Ребёнок', f'video-2_{rows}_{i}')
+
+    results['save_submission'] = measure(save, max(iterations // 10, 20), warmup=2)
+
+    # Одновременные сохранения от многих обработчиков - здесь работает групповой коммит
+    threads_count, per_thread = 16, max(iterations // 50, 5)
+    def save_many():
+        for _ in range(per_thread):
+            save()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=save_many) for _ in range(threads_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    results['save_submission.concurrent16'] = {
+        'iterations': threads_count * per_thread,
+        'ops_per_s': round(threads_count * per_thread / elapsed, 1)
+    }
+
+    results['get_submissions_by_date'] = measure(lambda: bot.get_submissions_by_date(probe_date), iterations)
+    results['get_submissions_by_date.group'] = measure(
+        lambda: bot.get_submissions_by_date(probe_date, 'Земля'), iterations)
+    results['get_submissions_page'] = measure(
+        lambda: bot.get_submissions_page(probe_date, probe_date), iterations)
+
+    user_ids = [100000 + random.randrange(max(rows // 10, 1)) for _ in range(iterations)]
+    user_iter = iter(user_ids * 2)
+    results['get_user_setting.cached'] = measure(lambda: bot.get_user_setting(42), iterations)
+
+    def uncached():
+        user_id = next(user_iter)
+        with bot.settings_cache_lock:
+            bot.settings_cache.pop(user_id, None)
+        bot.get_user_setting(user_id)
+    results['get_user_setting.uncached'] = measure(uncached, iterations)
+    return results
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(current, baseline_path):
+    """Сравнение с предыдущим запуском; возвращает список регрессий"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = []
+    for section, benchmarks in current['results'].items():
+        for name, result in benchmarks.items():
+            old = baseline.get('results', {}).get(section, {}).get(name)
+            if not old or 'mean_us' not in result or 'mean_us' not in old:
+                continue
+            ratio = result['mean_us'] / old['mean_us'] if old['mean_us'] else 1.0
+            slower = ratio > REGRESSION_THRESHOLD and result['mean_us'] - old['mean_us'] > NOISE_FLOOR_US
+            marker = '🔴' if slower else '🟢'
+            print(f"{marker} {section} {name}: {old['mean_us']} → {result['mean_us']} мкс (x{ratio:.2f})")
+            if slower:
+                regressions.append(f'{section}/{name}')
+    for section, plans in current['query_plans'].items():
+        old_plans = baseline.get('query_plans', {}).get(section)
+        if not isinstance(old_plans, dict):
+            continue  # запуск старой версии: планы не по запросам
+        for name, plan in plans.items():
+            old_plan = old_plans.get(name)
+            if old_plan and old_plan != plan:
+                print(f"🔴 {section} {name}: изменился план запроса: {old_plan} → {plan}")
+                regressions.append(f'{section}/{name}/query_plan')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Микробенчмарки бота')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES),
+                        help='размеры базы (число заявок)')
+    parser.add_argument('--iterations', type=int, default=1000, help='повторов на бенчмарк')
+    parser.add_argument('--output', help='файл для результатов JSON')
+    parser.add_argument('--compare', help='JSON предыдущего запуска для сравнения')
+    args = parser.parse_args()
+    # Пути - до перехода в рабочую папку бота
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.compare) if args.compare else None
+
+    workdir = tempfile.mkdtemp(prefix='vk-bot-bench-')
+    bot = load_bot(workdir)
+    random.seed(1)
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'results': {'cpu': bench_cpu(bot, args.iterations)},
+        'query_plans': {}
+    }
+
+    current_rows = 0
+    for rows in sorted(args.sizes):
+        print(f"⏳ База {rows} заявок...", file=sys.stderr)
+        seed(bot, rows, current_rows)
+        current_rows = rows
+        section = f'db_{rows}'
+        report['results'][section] = bench_db(bot, rows, args.iterations)
+        report['query_plans'][section] = query_plans(bot)
+
+    bot.db_writer.stop()
+    report_json = json.dumps(report, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(report_json)
+    else:
+        print(report_json)
+
+    regressions = [problem for plans in report['query_plans'].values() for problem in check_plans(plans)]
+    for problem in regressions:
+        print(f"🔴 {problem}", file=sys.stderr)
+    if baseline:
+        regressions += compare(report, baseline)
+    if regressions:
+        print(f"❌ Регрессии: {', '.join(regressions)}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
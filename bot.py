@@ -1,7 +1,8 @@
 import vk_api
-from vk_api.bot_longpoll import VkBotLongPoll, VkBotEventType
+from vk_api.bot_longpoll import VkBotLongPoll, VkBotEventType, VkBotMessageEvent
 from vk_api.keyboard import VkKeyboard, VkKeyboardColor
 from vk_api.utils import get_random_id
+import requests
 import sqlite3
 import datetime
 import logging
@@ -10,119 +11,1075 @@ import sys
 import re
 import time
 import shutil
-from threading import Thread, Lock
-from flask import Flask
+import random
+import csv
+import io
+import hmac
+import zlib
+import gzip
+import bisect
+import functools
+import itertools
+import atexit
+import logging.handlers
+from threading import Thread, Lock, BoundedSemaphore, Event, Timer, Condition
+from queue import Queue, PriorityQueue, Empty, Full
+from concurrent.futures import Future
+from collections import deque, OrderedDict
+from flask import Flask, Blueprint, Response, request
 import json
+import signal
+from contextlib import contextmanager, nullcontext
 
 # ========== НАСТРОЙКИ ==========
 GROUP_TOKEN = os.environ.get('VK_TOKEN')
 GROUP_ID = os.environ.get('VK_GROUP_ID')
 PASSWORD = "050607"
+DB_PATH = 'bot_database.db'
+
+# Соединения с БД: одно на запись, пул только для чтения
+DB_READERS = int(os.environ.get('DB_READERS', 4))
+DB_STATEMENT_CACHE = 256  # подготовленных запросов на соединение
+DB_READER_WAIT = 30  # секунд ожидания свободного соединения для чтения
+
+# Параллельная обработка событий
+WORKER_COUNT = int(os.environ.get('BOT_WORKERS', 8))
+WORKER_QUEUE_SIZE = int(os.environ.get('BOT_QUEUE_SIZE', 500))
+# При остановке принятые события дообрабатываются не дольше BOT_STOP_TIMEOUT секунд
+# (хостинг ждёт завершения после SIGTERM около 30 секунд)
+WORKER_STOP_TIMEOUT = float(os.environ.get('BOT_STOP_TIMEOUT', 20))
+# Сколько последних событий помнить, чтобы отбрасывать повторную доставку longpoll
+EVENT_DEDUP_SIZE = int(os.environ.get('EVENT_DEDUP_SIZE', 10000))
+
+# Другой адрес VK API вместо https://api.vk.com (например, тестовый сервер loadtest.py)
+VK_API_URL = os.environ.get('VK_API_URL')
+
+# Получение событий: 'longpoll' - Bots Long Poll, 'callback' - Callback API
+# (VK присылает события POST-запросами на /callback веб-сервера бота)
+VK_EVENTS_MODE = os.environ.get('VK_EVENTS_MODE', 'longpoll')
+CALLBACK_CONFIRMATION = os.environ.get('VK_CALLBACK_CONFIRMATION', '')  # строка из настроек сервера
+CALLBACK_SECRET = os.environ.get('VK_CALLBACK_SECRET', '')
+
+# Longpoll: ожидание событий на сервере и переподключение с экспоненциальной
+# задержкой (со случайным разбросом) от LONGPOLL_RETRY_MIN до LONGPOLL_RETRY_MAX секунд
+LONGPOLL_WAIT = 25
+LONGPOLL_RETRY_MIN = float(os.environ.get('LONGPOLL_RETRY_MIN', 0.05))
+LONGPOLL_RETRY_MAX = float(os.environ.get('LONGPOLL_RETRY_MAX', 30))
+
+# Исходящие запросы к VK API: общий лимит запросов в секунду на процесс
+# (ограничение VK для ключа сообщества - 20) и число одновременных запросов
+VK_RATE_LIMIT = float(os.environ.get('VK_RATE_LIMIT', 20))
+VK_SENDERS = int(os.environ.get('VK_SENDERS', 4))
+# Объединение запросов к VK API в один execute (0 - без объединения)
+VK_BATCH_WINDOW = float(os.environ.get('VK_BATCH_WINDOW', 0.02))
+VK_EXECUTE_LIMIT = 25  # ограничение VK на число вызовов в одном execute
+# Повтор при ошибках 6 (много запросов), 9 (flood control), 10 (ошибка сервера VK)
+VK_RETRY_CODES = (6, 9, 10)
+VK_MAX_RETRIES = int(os.environ.get('VK_MAX_RETRIES', 5))
+VK_RETRY_BASE_DELAY = 0.5
+VK_RETRY_MAX_DELAY = 30
+
+# Выдача материалов педагогу: 'batch' - несколько видео в одном сообщении, 'single' - по одному
+TEACHER_DELIVERY_MODE = os.environ.get('TEACHER_DELIVERY_MODE', 'batch')
+MAX_ATTACHMENTS_PER_MESSAGE = 10  # ограничение VK на число вложений в сообщении
+# Материалов за одну выдачу педагогу; следующие - по кнопке «Показать ещё»
+TEACHER_PAGE_SIZE = int(os.environ.get('TEACHER_PAGE_SIZE', 20))
+
+# Кэш профилей VK (имя и фамилия)
+PROFILE_CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', 5000))
+PROFILE_CACHE_TTL = int(os.environ.get('PROFILE_CACHE_TTL', 6 * 3600))
+
+# Кэш настроек пользователей (use_bot)
+SETTINGS_CACHE_SIZE = int(os.environ.get('SETTINGS_CACHE_SIZE', 10000))
+
+# Сохранение незавершённых диалогов между перезапусками
+SESSION_FLUSH_INTERVAL = float(os.environ.get('SESSION_FLUSH_INTERVAL', 2))
+
+# Брошенные диалоги: сессия без активности дольше SESSION_IDLE_TTL_HOURS часов
+# удаляется, а сверх SESSION_MAX сессий вытесняются самые давние
+SESSION_IDLE_TTL = float(os.environ.get('SESSION_IDLE_TTL_HOURS', 24)) * 3600
+SESSION_MAX = int(os.environ.get('SESSION_MAX', 10000))
+
+# Групповая запись в БД: не больше WRITE_BATCH_SIZE операций в транзакции,
+# первая операция пачки ждёт попутчиков не дольше WRITE_MAX_LATENCY секунд.
+# При 0 коммит идёт сразу, а пачку составляют операции, накопившиеся за время
+# предыдущего коммита
+WRITE_BATCH_SIZE = int(os.environ.get('WRITE_BATCH_SIZE', 100))
+WRITE_MAX_LATENCY = float(os.environ.get('WRITE_MAX_LATENCY', 0))
+WRITE_TIMEOUT = 30
+
+# Резервное копирование
+BACKUP_DIR = 'backups'
+BACKUP_KEEP = 5
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_COMPRESS = os.environ.get('BACKUP_COMPRESS', '0') == '1'  # 1 - сжимать копии в .db.gz
+BACKUP_INTERVAL_HOURS = float(os.environ.get('BACKUP_INTERVAL_HOURS', 0))  # 0 - без расписания
+
+# Время жизни снимка статистики для /stats и главной страницы (секунды)
+STATS_TTL = float(os.environ.get('STATS_TTL', 5))
+STATS_RECENT_DATES = 30
+
+# Выгрузка заявок /export: доступ по токену (без токена выгрузка отключена),
+# строки читаются из БД страницами по EXPORT_PAGE_SIZE
+EXPORT_TOKEN = os.environ.get('EXPORT_TOKEN')
+EXPORT_PAGE_SIZE = int(os.environ.get('EXPORT_PAGE_SIZE', 1000))
+
+# Веб-сервер мониторинга: 'waitress' - многопоточный WSGI-сервер, 'dev' - встроенный сервер Flask
+WEB_SERVER = os.environ.get('WEB_SERVER', 'waitress')
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 8))  # одновременно обрабатываемых запросов
+WEB_CONNECTION_LIMIT = int(os.environ.get('WEB_CONNECTION_LIMIT', 100))
+# Отдельный процесс только с веб-сервером ('python bot.py web' или gunicorn 'bot:create_app()'):
+# БД открывается только на чтение, VK API не используется
+WEB_READ_ONLY = os.environ.get('WEB_READ_ONLY') == '1' or sys.argv[1:2] == ['web']
+
+def check_settings():
+    """Проверка обязательных настроек бота перед запуском"""
+    if not GROUP_TOKEN or not GROUP_ID:
+        print("❌ ОШИБКА: Не установлены переменные окружения VK_TOKEN и VK_GROUP_ID!")
+        sys.exit(1)
+
+# ========== ЛОГИРОВАНИЕ ==========
+# Обработчики вызывают только постановку записи в очередь; запись в файл и
+# терминал идёт в отдельном потоке QueueListener.
+LOG_FILE = os.environ.get('LOG_FILE', 'bot.log')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')  # 'text' или 'json' (одна запись - одна строка JSON)
+LOG_ROTATE_WHEN = os.environ.get('LOG_ROTATE_WHEN', '')  # '' - по размеру, 'midnight', 'h' и т.п. - по времени
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
+LOG_QUEUE_SIZE = 10000  # при переполнении записи отбрасываются, а не блокируют обработку
+# Логи на каждое входящее сообщение: не больше LOG_MESSAGE_RATE в секунду (0 - без ограничения)
+LOG_MESSAGE_RATE = float(os.environ.get('LOG_MESSAGE_RATE', 20))
+LOG_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога одной строкой JSON"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def gzip_rotator(source, dest):
+    """Ротация со сжатием: старый файл лога упаковывается в .gz"""
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+class MessageLogLimiter(logging.Filter):
+    """Ограничение частоты логов с extra={'rate_limited': True}
+
+    Корзина токенов на rate записей в секунду; число пропущенных записей
+    дописывается к следующей прошедшей.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._suppressed = 0
+        self._lock = Lock()
+
+    def filter(self, record):
+        if not self.rate or not getattr(record, 'rate_limited', False):
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                self._suppressed += 1
+                return False
+            self._tokens -= 1
+            suppressed, self._suppressed = self._suppressed, 0
+        if suppressed:
+            record.msg = f"{record.msg} (пропущено похожих записей: {suppressed})"
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который при переполнении очереди отбрасывает запись"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+log_queue_handler = None
+logging_lock = Lock()
+
+def setup_logging():
+    """Очередь логов на корневом логгере и поток записи в файл и терминал.
+
+    Вызывается точками входа (бот, веб-приложение), а не при импорте модуля;
+    повторный вызов ничего не делает.
+    """
+    global log_queue_handler
+    with logging_lock:
+        if log_queue_handler is None:
+            log_queue_handler = start_log_listener()
+    return log_queue_handler
+
+def start_log_listener():
+    formatter = JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(LOG_TEXT_FORMAT)
+    if LOG_ROTATE_WHEN:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    file_handler.namer = lambda name: name + '.gz'
+    file_handler.rotator = gzip_rotator
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    queue_handler = DroppingQueueHandler(Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(MessageLogLimiter(LOG_MESSAGE_RATE))
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(queue_handler.queue, file_handler, stream_handler,
+                                              respect_handler_level=True)
+    listener.start()
+    # При выходе дописываем всё, что осталось в очереди
+    atexit.register(listener.stop)
+    return queue_handler
 
-# Проверяем обязательные настройки
-if not GROUP_TOKEN or not GROUP_ID:
-    print("❌ ОШИБКА: Не установлены переменные окружения VK_TOKEN и VK_GROUP_ID!")
-    sys.exit(1)
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('bot.log', encoding='utf-8')
-    ]
-)
 logger = logging.getLogger(__name__)
 
+# ========== ЛЕНИВАЯ ИНИЦИАЛИЗАЦИЯ ==========
+class LazyResource:
+    """Объект, который создаётся фабрикой при первом обращении к его атрибутам.
+
+    Импорт модуля не открывает БД и не запускает потоков: это происходит,
+    когда ресурс впервые нужен обработчику, веб-запросу или точке входа.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._instance = None
+        self._lock = Lock()
+
+    def get(self):
+        """Созданный объект (при первом вызове - создание)"""
+        instance = self._instance
+        if instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+                instance = self._instance
+        return instance
+
+    @property
+    def initialized(self):
+        return self._instance is not None
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+class StartupTimer:
+    """Длительность этапов запуска: пишется в лог и отдаётся в /stats"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.total_ms = None
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round((time.perf_counter() - started) * 1000, 1)
+
+    def ready(self):
+        """Запуск завершён: итог в лог"""
+        self.total_ms = round((time.perf_counter() - self.started) * 1000, 1)
+        phases = ', '.join(f'{name} {ms} мс' for name, ms in self.phases.items())
+        logger.info(f"⏱️ Запуск за {self.total_ms} мс" + (f" ({phases})" if phases else ""))
+
+    @property
+    def is_ready(self):
+        return self.total_ms is not None
+
+    def status(self):
+        return {'ready': self.is_ready, 'total_ms': self.total_ms, 'phases': dict(self.phases)}
+
+startup = StartupTimer()
+
+# ========== МЕТРИКИ ==========
+# Метрики в текстовом формате Prometheus. Запись метрики - несколько операций
+# со словарём под собственной блокировкой, поэтому их можно не отключать в продакшене.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS = []
+
+def format_labels(names, values):
+    """Метки в формате {name="value",...}"""
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(names, escaped))
+    return '{' + pairs + '}'
+
+class Counter:
+    """Монотонно растущий счётчик"""
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+        self._lock = Lock()
+        METRICS.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            values = dict(self._values)
+        yield f'# HELP {self.name} {self.description}'
+        yield f'# TYPE {self.name} counter'
+        for label_values, value in values.items():
+            yield f'{self.name}{format_labels(self.labels, label_values)} {value}'
+
+class Gauge:
+    """Текущее значение; считается функцией в момент сбора метрик.
+    Функция возвращает число или словарь {значения меток: число}"""
+
+    def __init__(self, name, description, labels=(), function=None):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.function = function
+        METRICS.append(self)
+
+    def set_function(self, function):
+        self.function = function
+
+    def collect(self):
+        if self.function is None:
+            return
+        try:
+            value = self.function()
+        except Exception as e:
+            logger.error(f"❌ Ошибка сбора метрики {self.name}: {e}")
+            return
+        yield f'# HELP {self.name} {self.description}'
+        yield f'# TYPE {self.name} gauge'
+        if isinstance(value, dict):
+            for label_values, item in value.items():
+                if not isinstance(label_values, tuple):
+                    label_values = (label_values,)
+                yield f'{self.name}{format_labels(self.labels, label_values)} {item}'
+        else:
+            yield f'{self.name} {value}'
+
+class Histogram:
+    """Гистограмма длительностей (секунды) с фиксированными корзинами"""
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # значения меток -> [счётчики корзин..., сумма, количество]
+        self._lock = Lock()
+        METRICS.append(self)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        """Замер длительности блока кода"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def collect(self):
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        yield f'# HELP {self.name} {self.description}'
+        yield f'# TYPE {self.name} histogram'
+        label_names = self.labels + ('le',)
+        for label_values, values in series.items():
+            cumulative = 0
+            for bucket, count in zip(self.buckets, values):
+                cumulative += count
+                yield f'{self.name}_bucket{format_labels(label_names, label_values + (bucket,))} {cumulative}'
+            yield f'{self.name}_bucket{format_labels(label_names, label_values + ("+Inf",))} {values[-1]}'
+            yield f'{self.name}_sum{format_labels(self.labels, label_values)} {values[-2]}'
+            yield f'{self.name}_count{format_labels(self.labels, label_values)} {values[-1]}'
+
+def render_metrics():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.collect())
+    return '\n'.join(lines) + '\n'
+
+HANDLER_DURATION = Histogram('bot_handler_duration_seconds',
+                             'Длительность обработчиков сообщений', ('handler',))
+VK_REQUEST_DURATION = Histogram('bot_vk_request_duration_seconds',
+                                'Длительность запросов к VK API', ('method',))
+VK_REQUEST_ERRORS = Counter('bot_vk_request_errors_total',
+                            'Ошибки запросов к VK API по коду ошибки', ('method', 'code'))
+DB_LOCK_WAIT = Histogram('bot_db_lock_wait_seconds', 'Ожидание блокировки записи в БД')
+DB_LOCK_HOLD = Histogram('bot_db_lock_hold_seconds', 'Удержание блокировки записи в БД')
+EVENT_QUEUE_LAG = Histogram('bot_event_queue_lag_seconds',
+                            'Задержка события в очереди до начала обработки')
+EVENT_QUEUE_DEPTH = Gauge('bot_event_queue_depth', 'События, ожидающие обработки')
+ACTIVE_SESSIONS = Gauge('bot_active_sessions', 'Незавершённые диалоги в user_states')
+SUBMISSIONS_BY_GROUP = Gauge('bot_submissions', 'Заявки по группам', ('group',))
+VK_REQUEST_RETRIES = Counter('bot_vk_request_retries_total',
+                             'Повторы запросов к VK API по коду ошибки', ('method', 'code'))
+VK_OUTBOUND_QUEUE_DEPTH = Gauge('bot_vk_outbound_queue_depth', 'Запросы к VK API, ожидающие отправки')
+DUPLICATE_EVENTS = Counter('bot_duplicate_events_total', 'Отброшенные повторно доставленные события')
+SESSIONS_EXPIRED = Counter('bot_sessions_expired_total',
+                           'Удалённые брошенные диалоги по причине (idle, capacity)', ('reason',))
+LOG_QUEUE_DEPTH = Gauge('bot_log_queue_depth', 'Записи лога, ожидающие записи в файл',
+                        function=lambda: log_queue_handler.queue.qsize() if log_queue_handler else 0)
+LOG_DROPPED = Gauge('bot_log_dropped_records', 'Записи лога, отброшенные при переполнении очереди',
+                    function=lambda: log_queue_handler.dropped if log_queue_handler else 0)
+
+def timed_handler(handler):
+    """Декоратор: замер длительности обработчика в HANDLER_DURATION"""
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        with HANDLER_DURATION.time(handler.__name__):
+            return handler(*args, **kwargs)
+    return wrapper
+
 # ========== БАЗА ДАННЫХ ==========
-db_lock = Lock()
+def to_iso_date(date_text):
+    """Преобразование даты 'дд.мм.гггг' в 'гггг-мм-дд' (None, если формат неверный)"""
+    try:
+        return datetime.datetime.strptime(date_text.strip(), '%d.%m.%Y').strftime('%Y-%m-%d')
+    except (ValueError, AttributeError):
+        return None
+
+def migrate_database(cursor):
+    """Миграции схемы для уже существующих баз"""
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(submissions)')}
+    
+    # Нормализованная дата: по ней работают диапазоны и сортировка
+    if 'date_iso' not in columns:
+        cursor.execute('ALTER TABLE submissions ADD COLUMN date_iso TEXT')
+        rows = cursor.execute('SELECT id, date FROM submissions').fetchall()
+        cursor.executemany('UPDATE submissions SET date_iso = ? WHERE id = ?',
+                           [(to_iso_date(date), row_id) for row_id, date in rows])
+        logger.info(f"✅ Миграция: заполнена дата ISO для {len(rows)} заявок")
+    
+    # Уникальность заявки: перед созданием индекса убираем накопившиеся дубли
+    has_unique = cursor.execute('''
+        SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_submission_unique'
+    ''').fetchone()
+    if not has_unique:
+        cursor.execute('''
+            DELETE FROM submissions WHERE id NOT IN (
+                SELECT MIN(id) FROM submissions
+                GROUP BY user_id, date_iso, child_name, video_attachment
+            )
+        ''')
+        if cursor.rowcount:
+            logger.info(f"✅ Миграция: удалено повторных заявок: {cursor.rowcount}")
+        cursor.execute('''
+            CREATE UNIQUE INDEX idx_submission_unique
+            ON submissions(user_id, date_iso, child_name, video_attachment)
+        ''')
+    
+    # Все запросы идут по date_iso: индекс по исходному тексту даты только замедлял вставку
+    cursor.execute('DROP INDEX IF EXISTS idx_date')
+
+def init_stats_tables(cursor):
+    """Таблицы агрегатов для статистики, обновляемые триггерами при записи"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_totals (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_by_group (
+            group_name TEXT PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_by_date (
+            date_iso TEXT PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_submissions_insert AFTER INSERT ON submissions
+        BEGIN
+            UPDATE stats_totals SET value = value + 1 WHERE name = 'submissions';
+            INSERT INTO stats_by_group (group_name, count) VALUES (NEW.group_name, 1)
+                ON CONFLICT(group_name) DO UPDATE SET count = count + 1;
+            INSERT INTO stats_by_date (date_iso, count) VALUES (COALESCE(NEW.date_iso, ''), 1)
+                ON CONFLICT(date_iso) DO UPDATE SET count = count + 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_submissions_delete AFTER DELETE ON submissions
+        BEGIN
+            UPDATE stats_totals SET value = value - 1 WHERE name = 'submissions';
+            UPDATE stats_by_group SET count = count - 1 WHERE group_name = OLD.group_name;
+            UPDATE stats_by_date SET count = count - 1 WHERE date_iso = COALESCE(OLD.date_iso, '');
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_submissions_group_update AFTER UPDATE OF group_name ON submissions
+        WHEN OLD.group_name IS NOT NEW.group_name
+        BEGIN
+            UPDATE stats_by_group SET count = count - 1 WHERE group_name = OLD.group_name;
+            INSERT INTO stats_by_group (group_name, count) VALUES (NEW.group_name, 1)
+                ON CONFLICT(group_name) DO UPDATE SET count = count + 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_user_settings_insert AFTER INSERT ON user_settings
+        BEGIN
+            UPDATE stats_totals SET value = value + 1 WHERE name = 'users';
+            UPDATE stats_totals SET value = value + (NEW.use_bot = FALSE) WHERE name = 'message_mode_users';
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_user_settings_update AFTER UPDATE OF use_bot ON user_settings
+        BEGIN
+            UPDATE stats_totals SET value = value + (NEW.use_bot = FALSE) - (OLD.use_bot = FALSE)
+            WHERE name = 'message_mode_users';
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_user_settings_delete AFTER DELETE ON user_settings
+        BEGIN
+            UPDATE stats_totals SET value = value - 1 WHERE name = 'users';
+            UPDATE stats_totals SET value = value - (OLD.use_bot = FALSE) WHERE name = 'message_mode_users';
+        END
+    ''')
+    
+    # Первый запуск с агрегатами - заполняем их по существующим данным
+    if cursor.execute('SELECT COUNT(*) FROM stats_totals').fetchone()[0] == 0:
+        cursor.execute('''
+            INSERT INTO stats_totals (name, value)
+            SELECT 'submissions', COUNT(*) FROM submissions
+            UNION ALL SELECT 'users', COUNT(*) FROM user_settings
+            UNION ALL SELECT 'message_mode_users', COUNT(*) FROM user_settings WHERE use_bot = FALSE
+        ''')
+        cursor.execute('''
+            INSERT INTO stats_by_group (group_name, count)
+            SELECT group_name, COUNT(*) FROM submissions GROUP BY group_name
+        ''')
+        cursor.execute('''
+            INSERT INTO stats_by_date (date_iso, count)
+            SELECT COALESCE(date_iso, ''), COUNT(*) FROM submissions GROUP BY COALESCE(date_iso, '')
+        ''')
+        logger.info("✅ Агрегаты статистики заполнены")
 
 def init_database():
     """Инициализация базы данных SQLite"""
     try:
-        with db_lock:
-            conn = sqlite3.connect('bot_database.db', check_same_thread=False, timeout=30)
-            conn.execute('PRAGMA journal_mode=WAL')
-            cursor = conn.cursor()
-            
-            # Таблица для заявок от родителей
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS submissions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    user_name TEXT,
-                    group_name TEXT NOT NULL,
-                    date TEXT NOT NULL,
-                    child_name TEXT NOT NULL,
-                    video_attachment TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Таблица для настроек пользователей
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS user_settings (
-                    user_id INTEGER PRIMARY KEY,
-                    use_bot BOOLEAN DEFAULT TRUE,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Индексы для быстрого поиска
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_date ON submissions(date)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_id ON submissions(user_id)')
-            
-            conn.commit()
-            logger.info("✅ База данных инициализирована")
-            return conn
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30,
+                               cached_statements=DB_STATEMENT_CACHE)
+        conn.execute('PRAGMA journal_mode=WAL')
+        cursor = conn.cursor()
+        
+        # Таблица для заявок от родителей
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS submissions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                user_name TEXT,
+                group_name TEXT NOT NULL,
+                date TEXT NOT NULL,
+                child_name TEXT NOT NULL,
+                video_attachment TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                date_iso TEXT
+            )
+        ''')
+        
+        # Таблица для настроек пользователей
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_settings (
+                user_id INTEGER PRIMARY KEY,
+                use_bot BOOLEAN DEFAULT TRUE,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Таблица незавершённых диалогов (состояния пользователей)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Служебные значения бота (позиция longpoll и т.п.)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bot_state (
+                name TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        migrate_database(cursor)
+        
+        # Индексы для быстрого поиска
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_id ON submissions(user_id)')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_date_group_created
+            ON submissions(date_iso, group_name, created_at)
+        ''')
+        # Постраничная выдача за дату: поиск по дате и порядок (created_at, id) из индекса
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_date_created ON submissions(date_iso, created_at)')
+        
+        init_stats_tables(cursor)
+        
+        conn.commit()
+        logger.info("✅ База данных инициализирована")
+        return conn
     except Exception as e:
         logger.error(f"❌ Ошибка инициализации БД: {e}")
         sys.exit(1)
 
-# Инициализируем базу данных
-db_connection = init_database()
+class Database:
+    """Менеджер соединений с БД.
+
+    Запись идёт через единственное соединение под write_lock(), чтение - через
+    пул соединений только для чтения. В режиме WAL читатели не ждут писателя,
+    поэтому веб-сервер и обработчики не блокируют друг друга. Соединения
+    переиспользуются, вместе с ними - кэш подготовленных запросов.
+    """
+
+    def __init__(self, path, writer, readers=DB_READERS):
+        self.path = path
+        self.writer = writer
+        self._write_lock = Lock()
+        self._readers = Queue()
+        self._readers_left = readers
+        self._readers_lock = Lock()
+        self._all_readers = []
+        self._stats_lock = Lock()
+        self._lock_stats = {'acquisitions': 0, 'wait_total': 0.0, 'wait_max': 0.0,
+                            'hold_total': 0.0, 'hold_max': 0.0}
+
+    @contextmanager
+    def write_lock(self):
+        """Захват соединения на запись с замером ожидания и удержания блокировки"""
+        started = time.perf_counter()
+        with self._write_lock:
+            acquired = time.perf_counter()
+            try:
+                yield self.writer
+            finally:
+                self._record_lock(acquired - started, time.perf_counter() - acquired)
+
+    def _record_lock(self, wait, hold):
+        DB_LOCK_WAIT.observe(wait)
+        DB_LOCK_HOLD.observe(hold)
+        with self._stats_lock:
+            stats = self._lock_stats
+            stats['acquisitions'] += 1
+            stats['wait_total'] += wait
+            stats['wait_max'] = max(stats['wait_max'], wait)
+            stats['hold_total'] += hold
+            stats['hold_max'] = max(stats['hold_max'], hold)
+
+    def lock_stats(self):
+        """Статистика ожидания блокировки записи (в миллисекундах)"""
+        with self._stats_lock:
+            stats = dict(self._lock_stats)
+        count = stats['acquisitions'] or 1
+        return {
+            'acquisitions': stats['acquisitions'],
+            'wait_avg_ms': round(stats['wait_total'] / count * 1000, 3),
+            'wait_max_ms': round(stats['wait_max'] * 1000, 3),
+            'hold_avg_ms': round(stats['hold_total'] / count * 1000, 3),
+            'hold_max_ms': round(stats['hold_max'] * 1000, 3)
+        }
+
+    def _open_reader(self):
+        conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True,
+                               check_same_thread=False, timeout=30,
+                               cached_statements=DB_STATEMENT_CACHE)
+        self._all_readers.append(conn)
+        return conn
+
+    def _acquire_reader(self):
+        """Новое соединение, пока не исчерпан лимит, иначе - ожидание возврата в пул"""
+        with self._readers_lock:
+            can_open = self._readers_left > 0
+            if can_open:
+                self._readers_left -= 1
+        if can_open:
+            try:
+                return self._open_reader()
+            except Exception:
+                # Например, БД ещё не создана процессом бота: место в пуле возвращаем
+                with self._readers_lock:
+                    self._readers_left += 1
+                raise
+        try:
+            return self._readers.get(timeout=DB_READER_WAIT)
+        except Empty:
+            raise sqlite3.OperationalError(
+                f"Нет свободного соединения для чтения за {DB_READER_WAIT} с") from None
+
+    @contextmanager
+    def reader(self):
+        """Соединение только для чтения из пула"""
+        try:
+            conn = self._readers.get_nowait()
+        except Empty:
+            conn = self._acquire_reader()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    def fetchall(self, sql, params=()):
+        """Выполнение запроса на чтение, все строки"""
+        with self.reader() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def fetchone(self, sql, params=()):
+        """Выполнение запроса на чтение, первая строка"""
+        with self.reader() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    def close(self):
+        """Закрытие всех соединений"""
+        for conn in self._all_readers:
+            conn.close()
+        if self.writer:
+            self.writer.close()
+
+def open_database():
+    """Открытие БД (в процессе только для веба - без соединения на запись и миграций)"""
+    return Database(DB_PATH, None if WEB_READ_ONLY else init_database())
+
+db = LazyResource(open_database)
+
+# ========== ЗАПИСЬ В БД ==========
+class DatabaseWriter:
+    """Единственный поток записи в БД с групповым коммитом.
+
+    Операции ставятся в очередь, поток забирает их пачками (до batch_size
+    операций или max_latency секунд ожидания) и фиксирует одной транзакцией.
+    Каждая операция получает Future, который завершается после коммита -
+    то есть когда данные уже надёжно записаны.
+    """
+
+    def __init__(self, db, batch_size=WRITE_BATCH_SIZE, max_latency=WRITE_MAX_LATENCY):
+        self.db = db
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self._queue = Queue()
+        self._thread = Thread(target=self._run, name='db-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, sql, params=(), many=False):
+        """Постановка операции в очередь; возвращает Future с числом изменённых строк"""
+        future = Future()
+        self._queue.put((sql, params, many, future))
+        return future
+
+    def _collect(self):
+        """Сбор пачки операций: ждём первую, затем добираем до лимита или таймаута"""
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                # Накопившееся за время предыдущего коммита забираем сразу,
+                # новые операции ждём только до deadline
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except Empty:
+                break
+            if item is None:
+                # Сигнал остановки обработаем после записи текущей пачки
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _execute(self, cursor, sql, params, many):
+        if many:
+            cursor.executemany(sql, params)
+        else:
+            cursor.execute(sql, params)
+        return cursor.rowcount
+
+    def _commit_batch(self, batch):
+        with self.db.write_lock() as conn:
+            cursor = conn.cursor()
+            try:
+                results = [self._execute(cursor, sql, params, many)
+                           for sql, params, many, _ in batch]
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                if len(batch) == 1:
+                    batch[0][3].set_exception(e)
+                    return
+                # Ошибка одной операции не должна отменять остальные:
+                # повторяем пачку по одной операции
+                logger.error(f"❌ Ошибка групповой записи ({len(batch)} операций), повтор по одной: {e}")
+                results = None
+
+        if results is None:
+            for item in batch:
+                self._commit_batch([item])
+            return
+        for (_, _, _, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            try:
+                self._commit_batch(batch)
+            except Exception as e:
+                logger.error(f"❌ Ошибка потока записи в БД: {e}")
+                for _, _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def stop(self):
+        """Запись оставшихся операций и остановка потока"""
+        self._queue.put(None)
+        self._thread.join()
+
+def create_db_writer():
+    if WEB_READ_ONLY:
+        raise RuntimeError("БД открыта только на чтение (WEB_READ_ONLY)")
+    return DatabaseWriter(db)
+
+db_writer = LazyResource(create_db_writer)
 
 def save_submission(user_id, user_name, group_name, date, child_name, video_attachment):
-    """Сохранение заявки в базу данных"""
+    """Сохранение заявки в базу данных (возвращает управление после коммита).
+
+    Повторная заявка с тем же видео на ту же дату не создаёт новую строку:
+    в существующей обновляются группа и имя отправителя, так что сохранённые
+    данные совпадают с теми, что бот подтвердил пользователю.
+    """
     try:
-        with db_lock:
-            cursor = db_connection.cursor()
-            cursor.execute('''
-                INSERT INTO submissions (user_id, user_name, group_name, date, child_name, video_attachment)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (user_id, user_name, group_name, date, child_name, video_attachment))
-            db_connection.commit()
+        changed = db_writer.submit('''
+            INSERT INTO submissions (user_id, user_name, group_name, date, date_iso, child_name, video_attachment)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, date_iso, child_name, video_attachment) DO UPDATE
+                SET group_name = excluded.group_name, user_name = excluded.user_name
+                WHERE group_name IS NOT excluded.group_name OR user_name IS NOT excluded.user_name
+        ''', (user_id, user_name, group_name, date, to_iso_date(date), child_name,
+              video_attachment)).result(WRITE_TIMEOUT)
+        if changed:
             logger.info(f"✅ Сохранена заявка: {child_name}, группа: {group_name}")
-            return True
+        else:
+            logger.info(f"♻️ Повторная заявка пропущена: {child_name}, группа: {group_name}")
+        return True
     except Exception as e:
         logger.error(f"❌ Ошибка сохранения заявки: {e}")
         return False
 
-def get_submissions_by_date(date):
-    """Получение всех заявок за определенную дату"""
+def submission_filter(date_from, date_to, group_name=None):
+    """Условие WHERE и параметры для заявок за период 'дд.мм.гггг' (и группы)"""
+    iso_from, iso_to = to_iso_date(date_from), to_iso_date(date_to)
+    if iso_from == iso_to:
+        # Равенство, а не BETWEEN: тогда порядок по created_at берётся из индекса
+        conditions, params = ['date_iso = ?'], [iso_from]
+    else:
+        conditions, params = ['date_iso BETWEEN ? AND ?'], [iso_from, iso_to]
+    if group_name is not None:
+        conditions.append('group_name = ?')
+        params.append(group_name)
+    return ' AND '.join(conditions), params
+
+def submissions_by_date_query(date, group_name=None):
+    """SQL и параметры get_submissions_by_date (бенчмарки проверяют план этого запроса)"""
+    where, params = submission_filter(date, date, group_name)
+    return f'''
+        SELECT child_name, video_attachment, group_name, user_name
+        FROM submissions
+        WHERE {where}
+        ORDER BY created_at DESC
+    ''', params
+
+def get_submissions_by_date(date, group_name=None):
+    """Получение всех заявок за определенную дату (при необходимости - только одной группы)"""
     try:
-        with db_lock:
-            cursor = db_connection.cursor()
-            cursor.execute('''
-                SELECT child_name, video_attachment, group_name, user_name 
-                FROM submissions 
-                WHERE date = ?
-                ORDER BY created_at DESC
-            ''', (date,))
-            return cursor.fetchall()
+        return db.fetchall(*submissions_by_date_query(date, group_name))
     except Exception as e:
         logger.error(f"❌ Ошибка получения заявок: {e}")
         return []
 
+def count_submissions(date_from, date_to, group_name=None):
+    """Количество заявок за период"""
+    try:
+        where, params = submission_filter(date_from, date_to, group_name)
+        return db.fetchone(f'SELECT COUNT(*) FROM submissions WHERE {where}', params)[0]
+    except Exception as e:
+        logger.error(f"❌ Ошибка подсчёта заявок: {e}")
+        return 0
+
+def submissions_page_query(date_from, date_to, group_name=None, after=None, page_size=TEACHER_PAGE_SIZE):
+    """SQL и параметры страницы get_submissions_page"""
+    where, params = submission_filter(date_from, date_to, group_name)
+    if after is not None:
+        where += ' AND (created_at, id) > (?, ?)'
+        params.extend(after)
+    # Одна лишняя строка показывает, есть ли следующая страница
+    return f'''
+        SELECT child_name, video_attachment, group_name, user_name, date, created_at, id
+        FROM submissions
+        WHERE {where}
+        ORDER BY created_at, id
+        LIMIT ?
+    ''', params + [page_size + 1]
+
+def get_submissions_page(date_from, date_to, group_name=None, after=None, page_size=TEACHER_PAGE_SIZE):
+    """Страница заявок за период по порядку (created_at, id).
+
+    after - курсор (created_at, id) последней выданной заявки, None - с начала.
+    Возвращает (строки, курсор следующей страницы или None, если это последняя).
+    Строки: child_name, video_attachment, group_name, user_name, date.
+    """
+    try:
+        rows = db.fetchall(*submissions_page_query(date_from, date_to, group_name, after, page_size))
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения страницы заявок: {e}")
+        return [], None
+    
+    page = rows[:page_size]
+    next_cursor = [page[-1][5], page[-1][6]] if len(rows) > page_size else None
+    return [row[:5] for row in page], next_cursor
+
+class StatsSnapshot:
+    """Снимок агрегатов статистики, перечитывается не чаще раза в STATS_TTL секунд"""
+
+    def __init__(self, ttl=STATS_TTL):
+        self.ttl = ttl
+        self._lock = Lock()
+        self._loaded_at = 0.0
+        self._data = None
+
+    def _load(self):
+        with db.reader() as conn:
+            totals = dict(conn.execute('SELECT name, value FROM stats_totals').fetchall())
+            by_group = conn.execute('''
+                SELECT group_name, count FROM stats_by_group
+                WHERE count > 0 ORDER BY group_name
+            ''').fetchall()
+            by_date = conn.execute('''
+                SELECT date_iso, count FROM stats_by_date
+                WHERE count > 0 ORDER BY date_iso DESC
+                LIMIT ?
+            ''', (STATS_RECENT_DATES,)).fetchall()
+            # id растёт вместе с created_at, а по нему есть индекс (первичный ключ)
+            recent = conn.execute('''
+                SELECT child_name, group_name, date, created_at
+                FROM submissions
+                ORDER BY id DESC
+                LIMIT 5
+            ''').fetchall()
+        return {
+            'total_submissions': totals.get('submissions', 0),
+            'total_users': totals.get('users', 0),
+            'message_mode_users': totals.get('message_mode_users', 0),
+            'bot_mode_users': totals.get('users', 0) - totals.get('message_mode_users', 0),
+            'by_group': dict(by_group),
+            'by_date': dict(by_date),
+            'recent_submissions': recent
+        }
+
+    def get(self):
+        """Текущий снимок (перечитывается из БД, если устарел)"""
+        with self._lock:
+            if self._data is None or time.monotonic() - self._loaded_at > self.ttl:
+                self._data = self._load()
+                self._loaded_at = time.monotonic()
+            return self._data
+
+stats_snapshot = StatsSnapshot()
+
+# Кэш настроек: user_id -> use_bot. Обновляется при записи (write-through),
+# поэтому для пользователей из кэша не нужны ни блокировки БД, ни запрос
+settings_cache = OrderedDict()
+settings_cache_lock = Lock()
+
+def cache_user_setting(user_id, use_bot):
+    """Запись настройки в кэш с вытеснением давно не использовавшихся"""
+    with settings_cache_lock:
+        settings_cache[user_id] = use_bot
+        settings_cache.move_to_end(user_id)
+        while len(settings_cache) > SETTINGS_CACHE_SIZE:
+            settings_cache.popitem(last=False)
+
+def warm_settings_cache():
+    """Предзагрузка настроек недавно активных пользователей при старте"""
+    try:
+        rows = db.fetchall('''
+            SELECT user_id, use_bot FROM user_settings
+            ORDER BY updated_at DESC
+            LIMIT ?
+        ''', (SETTINGS_CACHE_SIZE,))
+        # Самые свежие - в конец, чтобы вытеснялись последними
+        for user_id, use_bot in reversed(rows):
+            cache_user_setting(user_id, use_bot)
+        logger.info(f"✅ Загружено настроек в кэш: {len(rows)}")
+    except Exception as e:
+        logger.error(f"❌ Ошибка загрузки настроек в кэш: {e}")
+
 def get_user_setting(user_id):
     """Получение настроек пользователя"""
+    with settings_cache_lock:
+        if user_id in settings_cache:
+            settings_cache.move_to_end(user_id)
+            return settings_cache[user_id]
+    
     try:
-        with db_lock:
-            cursor = db_connection.cursor()
-            cursor.execute('SELECT use_bot FROM user_settings WHERE user_id = ?', (user_id,))
-            result = cursor.fetchone()
-            return result[0] if result else True
+        result = db.fetchone('SELECT use_bot FROM user_settings WHERE user_id = ?', (user_id,))
+        use_bot = result[0] if result else True
+        cache_user_setting(user_id, use_bot)
+        return use_bot
     except Exception as e:
         logger.error(f"❌ Ошибка получения настроек пользователя: {e}")
         return True
@@ -130,21 +1087,183 @@ def get_user_setting(user_id):
 def set_user_setting(user_id, use_bot):
     """Сохранение настроек пользователя"""
     try:
-        with db_lock:
-            cursor = db_connection.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO user_settings (user_id, use_bot, updated_at)
-                VALUES (?, ?, CURRENT_TIMESTAMP)
-            ''', (user_id, use_bot))
-            db_connection.commit()
-            logger.info(f"✅ Настройки пользователя {user_id} обновлены: use_bot={use_bot}")
-            return True
+        # UPSERT, а не REPLACE: REPLACE удаляет строку в обход триггеров статистики
+        db_writer.submit('''
+            INSERT INTO user_settings (user_id, use_bot, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(user_id) DO UPDATE SET use_bot = excluded.use_bot, updated_at = excluded.updated_at
+        ''', (user_id, use_bot)).result(WRITE_TIMEOUT)
+        cache_user_setting(user_id, use_bot)
+        logger.info(f"✅ Настройки пользователя {user_id} обновлены: use_bot={use_bot}")
+        return True
     except Exception as e:
         logger.error(f"❌ Ошибка сохранения настроек: {e}")
         return False
 
+def get_bot_state(name):
+    """Служебное значение из bot_state (None, если не сохранено)"""
+    row = db.fetchone('SELECT value FROM bot_state WHERE name = ?', (name,))
+    return row[0] if row else None
+
+def set_bot_state(name, value):
+    """Сохранение служебного значения без ожидания коммита"""
+    return db_writer.submit('''
+        INSERT INTO bot_state (name, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(name) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+    ''', (name, str(value)))
+
 # ========== СИСТЕМА СОСТОЯНИЙ ==========
-user_states = {}
+class Session:
+    """Состояние диалога одного пользователя.
+
+    Набор полей фиксирован (__slots__), поэтому объект заметно меньше словаря.
+    Для обработчиков сессия ведёт себя как словарь: session['group'],
+    session.get('date'), session.update(...), dict(session). Незаполненного
+    поля в сессии «нет» - как отсутствующего ключа в словаре.
+    """
+
+    FIELDS = ('state', 'role', 'user_name', 'group', 'date', 'child_name',
+              'date_from', 'date_to', 'cursor', 'shown', 'delivered', 'total')
+    __slots__ = FIELDS + ('last_active',)
+
+    def __init__(self, data=(), last_active=None):
+        self.last_active = time.time() if last_active is None else last_active
+        self.update(data)
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(f'Неизвестное поле сессии: {key}')
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.FIELDS and hasattr(self, key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [key for key in self.FIELDS if hasattr(self, key)]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def update(self, data=()):
+        items = data.items() if hasattr(data, 'items') else data
+        for key, value in items:
+            self[key] = value
+
+    def to_dict(self):
+        """Поля сессии для сохранения в БД (без времени активности)"""
+        return dict(self.items())
+
+    @classmethod
+    def from_dict(cls, data, last_active=None):
+        """Сессия из сохранённых данных; поля от старых версий бота пропускаются"""
+        return cls({key: value for key, value in data.items() if key in cls.FIELDS}, last_active)
+
+class SessionTable:
+    """Сессии пользователей с ограниченным временем жизни и размером.
+
+    Записи хранятся в порядке последнего обращения (OrderedDict), поэтому
+    и самые давние по простою, и кандидаты на вытеснение всегда в начале.
+    Сессия, простоявшая дольше idle_ttl секунд, удаляется expire_idle(),
+    а при превышении max_sessions вытесняется самая давняя. Об истёкших
+    сессиях помним (тоже ограниченно), чтобы предупредить пользователя.
+
+    Блокировка внешняя - state_lock, как и для прежнего словаря.
+    """
+
+    def __init__(self, idle_ttl=SESSION_IDLE_TTL, max_sessions=SESSION_MAX):
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._expired = OrderedDict()
+
+    def _touch(self, user_id):
+        session = self._sessions[user_id]
+        session.last_active = time.time()
+        self._sessions.move_to_end(user_id)
+        return session
+
+    def __getitem__(self, user_id):
+        return self._touch(user_id)
+
+    def get(self, user_id, default=None):
+        if user_id not in self._sessions:
+            return default
+        return self._touch(user_id)
+
+    def peek(self, user_id):
+        """Сессия без отметки активности (для фоновой записи в БД)"""
+        return self._sessions.get(user_id)
+
+    def __setitem__(self, user_id, data):
+        session = data if isinstance(data, Session) else Session(data)
+        session.last_active = time.time()
+        self._sessions[user_id] = session
+        self._sessions.move_to_end(user_id)
+        self._expired.pop(user_id, None)
+        while len(self._sessions) > self.max_sessions:
+            evicted_id, _ = self._sessions.popitem(last=False)
+            self._expire(evicted_id, 'capacity')
+
+    def __delitem__(self, user_id):
+        del self._sessions[user_id]
+
+    def __contains__(self, user_id):
+        return user_id in self._sessions
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def restore(self, user_id, session):
+        """Добавление сохранённой сессии с её временем активности (по возрастанию)"""
+        self._sessions[user_id] = session
+        self._sessions.move_to_end(user_id)
+
+    def _expire(self, user_id, reason):
+        SESSIONS_EXPIRED.inc(reason)
+        self._expired[user_id] = None
+        while len(self._expired) > self.max_sessions:
+            self._expired.popitem(last=False)
+        # Строка в таблице sessions удалится при следующем сбросе
+        session_store.mark_dirty(user_id)
+
+    def expire_idle(self, now=None):
+        """Удаление сессий, простаивающих дольше idle_ttl; возвращает их число"""
+        deadline = (time.time() if now is None else now) - self.idle_ttl
+        expired = 0
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if session.last_active > deadline:
+                break
+            del self._sessions[user_id]
+            self._expire(user_id, 'idle')
+            expired += 1
+        return expired
+
+    def pop_expired(self, user_id):
+        """True, если сессия пользователя истекла и он ещё не был предупреждён"""
+        if user_id not in self._expired:
+            return False
+        del self._expired[user_id]
+        return True
+
+user_states = SessionTable()
 state_lock = Lock()
 
 class UserState:
@@ -157,6 +1276,102 @@ class UserState:
     PARENT_SEND_VIDEO = 6
     TEACHER_ENTER_PASSWORD = 7
     TEACHER_ENTER_DATE = 8
+    TEACHER_BROWSE = 9
+
+# ========== ХРАНЕНИЕ СЕССИЙ ==========
+class SessionStore:
+    """Отложенная запись user_states в БД.
+
+    Чтение состояний идёт только из памяти. Обработчик событий помечает
+    пользователя изменённым, а фоновый поток раз в SESSION_FLUSH_INTERVAL секунд
+    записывает все изменённые сессии одной транзакцией. Несколько переходов
+    одного пользователя между сбросами схлопываются в одну запись.
+    Перед каждым сбросом тот же поток удаляет истёкшие по простою сессии.
+    """
+
+    def __init__(self, interval=SESSION_FLUSH_INTERVAL):
+        self.interval = interval
+        self._dirty = set()
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+
+    def mark_dirty(self, user_id):
+        """Пометка сессии пользователя для записи"""
+        with self._lock:
+            self._dirty.add(user_id)
+
+    def restore(self):
+        """Загрузка сохранённых сессий в user_states при старте"""
+        try:
+            rows = db.fetchall('SELECT user_id, data, updated_at FROM sessions ORDER BY updated_at')
+            with state_lock:
+                for user_id, data, updated_at in rows:
+                    # updated_at - CURRENT_TIMESTAMP SQLite, то есть UTC
+                    last_active = datetime.datetime.strptime(updated_at, '%Y-%m-%d %H:%M:%S').replace(
+                        tzinfo=datetime.timezone.utc).timestamp()
+                    user_states.restore(user_id, Session.from_dict(json.loads(data), last_active))
+            logger.info(f"✅ Восстановлено незавершённых диалогов: {len(rows)}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка восстановления сессий: {e}")
+
+    def flush(self):
+        """Запись всех изменённых сессий одной транзакцией"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        if not dirty:
+            return
+
+        updated, deleted = [], []
+        with state_lock:
+            for user_id in dirty:
+                session = user_states.peek(user_id)
+                if session is None:
+                    deleted.append((user_id,))
+                else:
+                    updated.append((user_id, json.dumps(session.to_dict(), ensure_ascii=False)))
+
+        try:
+            futures = [
+                db_writer.submit('''
+                    INSERT OR REPLACE INTO sessions (user_id, data, updated_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP)
+                ''', updated, many=True),
+                db_writer.submit('DELETE FROM sessions WHERE user_id = ?', deleted, many=True)
+            ]
+            for future in futures:
+                future.result(WRITE_TIMEOUT)
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения сессий: {e}")
+            # Не теряем изменения: запишем при следующем сбросе
+            with self._lock:
+                self._dirty.update(dirty)
+
+    def expire_idle(self):
+        """Удаление брошенных диалогов; их строки удалит ближайший сброс"""
+        with state_lock:
+            expired = user_states.expire_idle()
+        if expired:
+            logger.info(f"⌛ Удалено брошенных диалогов: {expired}")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.expire_idle()
+            self.flush()
+
+    def start(self):
+        """Запуск фоновой записи"""
+        self._thread = Thread(target=self._run, name='session-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Остановка фоновой записи с финальным сбросом"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+session_store = SessionStore()
 
 # Список групп
 GROUPS = [
@@ -164,6 +1379,9 @@ GROUPS = [
     "Юпитер", "Кассиопея", "Венера", "Аврора", "Вега", 
     "Медведица", "Пегас/альфа/сириус", "Макси"
 ]
+GROUPS_SET = frozenset(GROUPS)
+# Нормализованное (нижний регистр) название -> название группы
+GROUPS_BY_NAME = {group.lower(): group for group in GROUPS}
 
 # ========== КЛАВИАТУРЫ ==========
 def create_main_menu_keyboard():
@@ -228,8 +1446,344 @@ def create_teacher_restart_keyboard():
     keyboard.add_button('⚙️ Настройки', color=VkKeyboardColor.SECONDARY)
     return keyboard.get_keyboard()
 
+def create_teacher_more_keyboard():
+    """Клавиатура педагога с продолжением выдачи материалов"""
+    keyboard = VkKeyboard(one_time=True)
+    keyboard.add_button(f'▶️ Показать ещё {TEACHER_PAGE_SIZE}', color=VkKeyboardColor.PRIMARY)
+    keyboard.add_line()
+    keyboard.add_button('🔄 Рестарт', color=VkKeyboardColor.POSITIVE)
+    keyboard.add_button('⚙️ Настройки', color=VkKeyboardColor.SECONDARY)
+    return keyboard.get_keyboard()
+
+# Клавиатуры не зависят от пользователя - сериализуем их в JSON один раз при загрузке
+MAIN_MENU_KEYBOARD = create_main_menu_keyboard()
+START_KEYBOARD = create_start_keyboard()
+SETTINGS_KEYBOARD = create_settings_keyboard()
+ROLE_KEYBOARD = create_role_keyboard()
+GROUPS_KEYBOARD = create_groups_keyboard()
+RESTART_KEYBOARD = create_restart_keyboard()
+TEACHER_RESTART_KEYBOARD = create_teacher_restart_keyboard()
+TEACHER_MORE_KEYBOARD = create_teacher_more_keyboard()
+
+# ========== VK API ==========
+class ApiUrlAdapter(requests.adapters.HTTPAdapter):
+    """Перенаправление запросов к https://api.vk.com на VK_API_URL"""
+
+    def __init__(self, base_url):
+        super().__init__()
+        self.base_url = base_url.rstrip('/')
+
+    def send(self, request, **kwargs):
+        request.url = self.base_url + request.url[len('https://api.vk.com'):]
+        return super().send(request, **kwargs)
+
+def create_vk_session():
+    """Создание сессии VK API (с перенаправлением на VK_API_URL, если он задан)"""
+    session = None
+    if VK_API_URL:
+        session = requests.Session()
+        session.mount('https://api.vk.com/', ApiUrlAdapter(VK_API_URL))
+        logger.info(f"🔀 Запросы к VK API перенаправляются на {VK_API_URL}")
+    vk_session = vk_api.VkApi(token=GROUP_TOKEN, session=session)
+    # Частоту запросов ограничивает планировщик исходящих запросов. Встроенная
+    # пауза vk_api (0.34 с под общей блокировкой на время всего запроса) сводила
+    # все потоки к ~3 последовательным запросам в секунду, а её обработчик
+    # ошибки 6 повторял запрос в обход планировщика
+    vk_session.RPS_DELAY = 0
+    vk_session.lock = nullcontext()
+    vk_session.error_handlers.pop(vk_api.vk_api.TOO_MANY_RPS_CODE, None)
+    return vk_session
+
+class ResumableLongPoll(VkBotLongPoll):
+    """Bots Long Poll с явной обработкой ответов failed и сохранением ts в БД.
+
+    После перезапуска опрос продолжается с сохранённого ts, поэтому события,
+    пришедшие во время простоя, не теряются (если VK ещё хранит их историю).
+    ts пачки сохраняется только после обработки всех её событий и всех
+    предыдущих пачек: после падения необработанные события придут повторно,
+    а повторная заявка не создаёт дубль.
+    """
+
+    TS_STATE = 'longpoll_ts'
+
+    def __init__(self, vk, group_id, wait=LONGPOLL_WAIT):
+        super().__init__(vk, group_id, wait)
+        saved_ts = get_bot_state(self.TS_STATE)
+        if saved_ts:
+            logger.info(f"🔁 Longpoll продолжается с ts={saved_ts} (сервер: ts={self.ts})")
+            self.ts = saved_ts
+        self._saved_ts = saved_ts
+        self._batches = deque()  # [ts, необработанных событий] в порядке получения
+        self._progress_lock = Lock()
+
+    def check(self):
+        """Один запрос a_check; при failed обновляет ts или ключ и возвращает []"""
+        response = self.session.get(self.url, params={
+            'act': 'a_check',
+            'key': self.key,
+            'ts': self.ts,
+            'wait': self.wait
+        }, timeout=self.wait + 10).json()
+
+        failed = response.get('failed')
+        if failed is None:
+            self.ts = response['ts']
+            return [self._parse_event(raw_event) for raw_event in response['updates']]
+        if failed == 1:
+            # История событий устарела или частично утеряна: продолжаем с нового ts
+            logger.warning(f"⚠️ Longpoll: история событий устарела, ts {self.ts} → {response['ts']}")
+            self.ts = response['ts']
+        elif failed == 2:
+            # Истёк ключ: получаем новый, ts сохраняем, чтобы не потерять события
+            logger.info("🔑 Longpoll: истёк ключ, запрашиваем новый")
+            self.update_longpoll_server(update_ts=False)
+        elif failed == 3:
+            # Информация утеряна: нужны и новый ключ, и новый ts
+            logger.warning("⚠️ Longpoll: информация о сессии утеряна, начинаем с нового ts")
+            self.update_longpoll_server()
+        else:
+            raise vk_api.exceptions.VkApiError(f'Неизвестный ответ longpoll: {response}')
+        return []
+
+    def track(self, count):
+        """Учёт пачки из count событий последнего check().
+
+        Возвращает функцию, которую обработчик вызывает после каждого события пачки.
+        """
+        batch = [self.ts, count]
+        with self._progress_lock:
+            self._batches.append(batch)
+
+        def done():
+            with self._progress_lock:
+                batch[1] -= 1
+            self._save_progress()
+
+        self._save_progress()
+        return done
+
+    def _save_progress(self):
+        """Сохранение ts последней пачки, события которой и всех предыдущих обработаны"""
+        with self._progress_lock:
+            ts = None
+            while self._batches and self._batches[0][1] == 0:
+                ts = self._batches.popleft()[0]
+            if ts is not None and ts != self._saved_ts:
+                # Под блокировкой: записи ts попадают в очередь записи по порядку
+                set_bot_state(self.TS_STATE, ts)
+                self._saved_ts = ts
+
+class ReconnectBackoff:
+    """Экспоненциальная задержка переподключения со случайным разбросом (full jitter)"""
+
+    def __init__(self, minimum=LONGPOLL_RETRY_MIN, maximum=LONGPOLL_RETRY_MAX):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.attempt = 0
+
+    def next_delay(self):
+        delay = min(self.maximum, self.minimum * 2 ** self.attempt)
+        self.attempt += 1
+        return random.uniform(self.minimum, max(self.minimum, delay))
+
+    def reset(self):
+        self.attempt = 0
+
+# ========== ИСХОДЯЩИЕ ЗАПРОСЫ VK ==========
+class Priority:
+    """Классы приоритета исходящих запросов: меньше - раньше"""
+    INTERACTIVE = 0  # ответы пользователям в диалоге, users.get
+    BULK = 1  # выдача материалов педагогу
+    BACKGROUND = 2  # упреждающая загрузка профилей
+
+class TokenBucket:
+    """Корзина токенов: не больше rate запросов в секунду, всплеск до capacity"""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self):
+        """Ожидание токена"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class OutboundScheduler:
+    """Единая очередь исходящих запросов к VK API.
+
+    Вызовы из всех потоков попадают в очередь с приоритетом: ответы в диалоге
+    обгоняют массовую выдачу материалов. VK_SENDERS потоков отправляют их,
+    беря токен из общей корзины (VK_RATE_LIMIT запросов в секунду), причём
+    одновременные вызовы (до VK_EXECUTE_LIMIT за window секунд) объединяются
+    в один execute. Ошибки 6/9/10 не возвращаются вызывающему, а повторяются
+    с экспоненциальной задержкой до VK_MAX_RETRIES раз; остальные ошибки
+    приходят вызывающему как ApiError со своим кодом, как при прямом вызове.
+    """
+
+    def __init__(self, session, rate=VK_RATE_LIMIT, senders=VK_SENDERS,
+                 window=VK_BATCH_WINDOW, limit=VK_EXECUTE_LIMIT):
+        self.session = session
+        self.window = window
+        self.limit = limit if window > 0 else 1
+        self.limiter = TokenBucket(rate)
+        self._queue = PriorityQueue()
+        self._sequence = itertools.count().__next__  # порядок внутри одного приоритета
+        self._collect_lock = Lock()
+        self._threads = []
+        for i in range(senders):
+            thread = Thread(target=self._run, name=f'vk-sender-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def call(self, method, params, priority=Priority.INTERACTIVE):
+        """Вызов метода; блокирует до получения результата"""
+        return self.submit(method, params, priority).result()
+
+    def submit(self, method, params, priority=Priority.INTERACTIVE):
+        """Постановка вызова в очередь без ожидания; возвращает Future"""
+        future = Future()
+        self._put(priority, (method, params, future, priority, 0))
+        return future
+
+    def _put(self, priority, item):
+        self._queue.put((priority, self._sequence(), item))
+
+    def pending_count(self):
+        """Запросы, ожидающие отправки"""
+        return self._queue.qsize()
+
+    def _collect(self):
+        """Пачка вызовов для одного запроса: первый по приоритету, затем добор до limit"""
+        with self._collect_lock:
+            _, _, first = self._queue.get()
+            if first is None:
+                return None
+            # Пока ждём токен, в очереди копятся попутные вызовы
+            self.limiter.acquire()
+            batch = [first]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.limit:
+                remaining = deadline - time.monotonic()
+                try:
+                    _, _, item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except Empty:
+                    break
+                if item is None:
+                    self._put(float('inf'), None)
+                    break
+                batch.append(item)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            try:
+                if len(batch) == 1:
+                    method, params, future, _, _ = batch[0]
+                    try:
+                        future.set_result(self.session.method(method, params))
+                    except vk_api.exceptions.ApiError as e:
+                        self._fail(batch[0], e)
+                else:
+                    self._execute(batch)
+            except Exception as e:
+                for item in batch:
+                    if not item[2].done():
+                        self._fail(item, e)
+
+    def _fail(self, item, error):
+        """Повтор вызова с задержкой или ошибка вызывающему"""
+        method, params, future, priority, attempt = item
+        code = getattr(error, 'code', None)
+        if code not in VK_RETRY_CODES or attempt >= VK_MAX_RETRIES:
+            future.set_exception(error)
+            return
+        VK_REQUEST_RETRIES.inc(method, code)
+        delay = min(VK_RETRY_MAX_DELAY, VK_RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1)
+        logger.warning(f"⚠️ VK API {method}: ошибка {code}, повтор через {delay:.1f} с "
+                       f"(попытка {attempt + 1} из {VK_MAX_RETRIES})")
+        timer = Timer(delay, self._put, (priority, (method, params, future, priority, attempt + 1)))
+        timer.daemon = True
+        timer.start()
+
+    def _execute(self, batch):
+        calls = ','.join(f'API.{method}({json.dumps(params, ensure_ascii=False)})'
+                         for method, params, _, _, _ in batch)
+        response = self.session.method('execute', {'code': f'return [{calls}];'}, raw=True)
+        if 'error' in response:
+            # Ошибка всего запроса (например, авторизации) - общая для всех вызовов
+            raise vk_api.exceptions.ApiError(self.session, 'execute', {}, response, response['error'])
+        
+        # Неудачный вызов возвращает false, его ошибка - в execute_errors по порядку
+        errors = iter(response.get('execute_errors', []))
+        for item, result in zip(batch, response['response']):
+            method, params, future, _, _ = item
+            if result is False:
+                error = next(errors, {'error_code': -1, 'error_msg': 'execute error'})
+                self._fail(item, vk_api.exceptions.ApiError(self.session, method, params, response, error))
+            else:
+                future.set_result(result)
+
+    def stop(self, timeout=5):
+        """Отправка уже поставленных запросов и остановка потоков"""
+        for _ in self._threads:
+            self._put(float('inf'), None)
+        for thread in self._threads:
+            thread.join(timeout)
+
+def create_vk_scheduler():
+    scheduler = OutboundScheduler(vk_session.get())
+    VK_OUTBOUND_QUEUE_DEPTH.set_function(scheduler.pending_count)
+    return scheduler
+
+# Сессия VK и планировщик создаются при первом запросе к VK API
+vk_session = LazyResource(create_vk_session)
+vk_scheduler = LazyResource(create_vk_scheduler)
+vk = None  # прямой вызов без планировщика (vk_scheduler = None), например заглушка в benchmarks.py
+
 # ========== ОСНОВНЫЕ ФУНКЦИИ ==========
-def send_message(user_id, message, keyboard=None, attachment=None):
+def call_vk(method, priority=Priority.INTERACTIVE, **params):
+    """Вызов метода VK API ('messages.send', 'users.get', ...) с замером времени и учётом ошибок"""
+    return call_vk_async(method, priority, **params).result()
+
+def call_vk_async(method, priority=Priority.INTERACTIVE, **params):
+    """Вызов метода VK API без ожидания результата; возвращает Future"""
+    started = time.perf_counter()
+
+    def record(future):
+        error = future.exception()
+        if isinstance(error, vk_api.exceptions.ApiError):
+            VK_REQUEST_ERRORS.inc(method, error.code)
+        elif error is not None:
+            VK_REQUEST_ERRORS.inc(method, 'network')
+        VK_REQUEST_DURATION.observe(time.perf_counter() - started, method)
+
+    if vk_scheduler is not None:
+        future = vk_scheduler.submit(method, params, priority)
+    else:
+        # Без планировщика (бенчмарки) - прямой вызов
+        future = Future()
+        try:
+            future.set_result(functools.reduce(getattr, method.split('.'), vk)(**params))
+        except Exception as e:
+            future.set_exception(e)
+    future.add_done_callback(record)
+    return future
+
+def send_message(user_id, message, keyboard=None, attachment=None, priority=Priority.INTERACTIVE):
     """Отправка сообщения пользователю"""
     try:
         params = {
@@ -243,7 +1797,7 @@ def send_message(user_id, message, keyboard=None, attachment=None):
         if attachment:
             params['attachment'] = attachment
             
-        vk.messages.send(**params)
+        call_vk('messages.send', priority, **params)
         return True
     except vk_api.exceptions.ApiError as e:
         logger.error(f"❌ Ошибка VK API при отправке сообщения {user_id}: {e}")
@@ -281,15 +1835,105 @@ def validate_name(name_text):
     
     return True, "✅ Имя корректно"
 
-def reset_user_state(user_id):
-    """Сброс состояния пользователя"""
-    with state_lock:
-        if user_id in user_states:
-            del user_states[user_id]
+def reset_user_state(user_id):
+    """Сброс состояния пользователя"""
+    with state_lock:
+        if user_id in user_states:
+            del user_states[user_id]
+
+# ========== КЭШ ПРОФИЛЕЙ ==========
+class ProfileCache:
+    """Кэш профилей пользователей VK с ограничением по времени жизни (TTL) и размеру (LRU)"""
+
+    def __init__(self, max_size=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()  # user_id -> (время загрузки, профиль)
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, user_id):
+        """Профиль из кэша или None (вызывается под self._lock)"""
+        item = self._items.get(user_id)
+        if item is None:
+            return None
+        loaded_at, profile = item
+        if time.monotonic() - loaded_at > self.ttl:
+            del self._items[user_id]
+            return None
+        self._items.move_to_end(user_id)
+        return profile
+
+    def _store(self, profiles):
+        now = time.monotonic()
+        with self._lock:
+            for profile in profiles:
+                self._items[profile['id']] = (now, profile)
+                self._items.move_to_end(profile['id'])
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def _fetch(self, user_ids):
+        """Загрузка профилей одним запросом users.get"""
+        try:
+            profiles = call_vk('users.get', user_ids=','.join(str(uid) for uid in user_ids),
+                               fields='first_name,last_name')
+        except Exception as e:
+            logger.error(f"❌ Ошибка получения профилей {list(user_ids)}: {e}")
+            return {}
+        self._store(profiles)
+        return {profile['id']: profile for profile in profiles}
+
+    def get(self, user_id):
+        """Профиль пользователя; загружается из VK только при промахе"""
+        with self._lock:
+            profile = self._lookup(user_id)
+            if profile is not None:
+                self.hits += 1
+                return profile
+            self.misses += 1
+        return self._fetch([user_id]).get(user_id)
+
+    def prefetch(self, user_ids):
+        """Фоновая загрузка одним запросом всех профилей, которых нет в кэше.
+
+        Не ждёт ответа: события передаются обработчикам сразу, а запрос идёт
+        с низшим приоритетом и не задерживает ответы пользователям.
+        """
+        with self._lock:
+            missing = {uid for uid in user_ids if self._lookup(uid) is None}
+        if not missing:
+            return
+        future = call_vk_async('users.get', Priority.BACKGROUND,
+                               user_ids=','.join(str(uid) for uid in sorted(missing)),
+                               fields='first_name,last_name')
+        future.add_done_callback(self._prefetched)
+
+    def _prefetched(self, future):
+        try:
+            self._store(future.result())
+        except Exception as e:
+            logger.error(f"❌ Ошибка упреждающей загрузки профилей: {e}")
+
+    def stats(self):
+        """Счётчики попаданий и промахов"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0
+            }
+
+profile_cache = ProfileCache()
 
-def get_user_display_name(user_id, user_info):
-    """Получение имени пользователя для логов"""
+def get_user_display_name(user_id, user_info=None):
+    """Получение имени пользователя для логов (профиль загружается лениво через кэш)"""
     try:
+        if user_info is None:
+            user_info = profile_cache.get(user_id)
         if user_info:
             first_name = user_info.get('first_name', '')
             last_name = user_info.get('last_name', '')
@@ -298,6 +1942,18 @@ def get_user_display_name(user_id, user_info):
     except:
         return f"Пользователь {user_id}"
 
+class LazyDisplayName:
+    """Имя пользователя как аргумент лога: профиль запрашивается только при
+    форматировании записи, то есть не для записей, отброшенных фильтрами"""
+    __slots__ = ('user_id', 'user_info')
+
+    def __init__(self, user_id, user_info=None):
+        self.user_id = user_id
+        self.user_info = user_info
+
+    def __str__(self):
+        return get_user_display_name(self.user_id, self.user_info)
+
 def is_video_attachment(attachments):
     """Проверка, что вложения содержат видео"""
     for attachment in attachments:
@@ -314,6 +1970,7 @@ def get_video_attachment(attachments):
     return None
 
 # ========== ОБРАБОТЧИКИ СОСТОЯНИЙ ==========
+@timed_handler
 def handle_main_menu(user_id, user_info):
     """Обработка главного меню"""
     with state_lock:
@@ -323,26 +1980,41 @@ def handle_main_menu(user_id, user_info):
                 "👋 Добро пожаловать! Выберите режим работы:\n\n"
                 "🤖 **Общаться с ботом** - автоматический сбор видео\n"
                 "💬 **Писать сообщения** - обычная переписка с администратором",
-                create_main_menu_keyboard())
-
-def handle_mode_selection(user_id, text, user_info):
-    """Обработка выбора режима"""
-    if 'бот' in text.lower():
-        set_user_setting(user_id, True)
-        handle_bot_start(user_id, user_info)
-    elif 'сообщен' in text.lower() or 'писать' in text.lower():
-        set_user_setting(user_id, False)
-        send_message(user_id,
-                    "💬 Вы перешли в режим обычных сообщений.\n"
-                    "Теперь ваши сообщения будут приходить администраторам группы.\n\n"
-                    "Чтобы вернуться к боту, отправьте любое сообщение или нажмите кнопку:",
-                    create_start_keyboard())
-        reset_user_state(user_id)
+                MAIN_MENU_KEYBOARD)
+
+@timed_handler
+def handle_bot_mode(user_id, user_info):
+    """Включение режима бота"""
+    set_user_setting(user_id, True)
+    handle_bot_start(user_id, user_info)
+
+@timed_handler
+def handle_messages_mode(user_id):
+    """Включение режима обычных сообщений"""
+    set_user_setting(user_id, False)
+    send_message(user_id,
+                "💬 Вы перешли в режим обычных сообщений.\n"
+                "Теперь ваши сообщения будут приходить администраторам группы.\n\n"
+                "Чтобы вернуться к боту, отправьте любое сообщение или нажмите кнопку:",
+                START_KEYBOARD)
+    reset_user_state(user_id)
+
+@timed_handler
+def handle_mode_selection(user_id, normalized, user_info):
+    """Выбор режима текстом (кнопки режима - в TRANSITIONS)"""
+    if handle_typed_command(user_id, normalized, user_info):
+        return
+    # Порядок проверок важен: «писать боту» - это режим бота
+    if 'бот' in normalized:
+        handle_bot_mode(user_id, user_info)
+    elif 'сообщен' in normalized or 'писать' in normalized:
+        handle_messages_mode(user_id)
     else:
         send_message(user_id,
                     "❌ Пожалуйста, выберите режим с помощью кнопок:",
-                    create_main_menu_keyboard())
+                    MAIN_MENU_KEYBOARD)
 
+@timed_handler
 def handle_bot_start(user_id, user_info):
     """Начало работы с ботом"""
     with state_lock:
@@ -351,8 +2023,9 @@ def handle_bot_start(user_id, user_info):
     send_message(user_id,
                 "🤖 Режим бота активирован!\n\n"
                 "Выберите вашу роль:",
-                create_role_keyboard())
+                ROLE_KEYBOARD)
 
+@timed_handler
 def handle_settings(user_id):
     """Обработка настроек"""
     current_mode = get_user_setting(user_id)
@@ -362,82 +2035,77 @@ def handle_settings(user_id):
                 f"⚙️ **Настройки**\n\n"
                 f"Текущий режим: {mode_text}\n\n"
                 f"Выберите новый режим:",
-                create_settings_keyboard())
+                SETTINGS_KEYBOARD)
 
-def handle_role_selection(user_id, text, user_info):
-    """Обработка выбора роли"""
-    if text == 'Родитель':
-        with state_lock:
-            user_states[user_id] = {
-                'state': UserState.PARENT_CHOOSE_GROUP,
-                'role': 'parent',
-                'user_name': get_user_display_name(user_id, user_info)
-            }
-        send_message(user_id,
-                    "👨‍👩‍👧 Выберите группу вашего ребенка:",
-                    create_groups_keyboard())
-    
-    elif text == 'Педагог':
-        with state_lock:
-            user_states[user_id] = {
-                'state': UserState.TEACHER_ENTER_PASSWORD,
-                'role': 'teacher'
-            }
-        send_message(user_id, "👩‍🏫 Введите пароль учётной записи педагога:")
-    
-    elif text == '🔙 Назад':
-        handle_main_menu(user_id, user_info)
-    
-    else:
+@timed_handler
+def handle_parent_role(user_id, user_info):
+    """Выбор роли родителя"""
+    with state_lock:
+        user_states[user_id] = {
+            'state': UserState.PARENT_CHOOSE_GROUP,
+            'role': 'parent',
+            'user_name': get_user_display_name(user_id, user_info)
+        }
+    send_message(user_id,
+                "👨‍👩‍👧 Выберите группу вашего ребенка:",
+                GROUPS_KEYBOARD)
+
+@timed_handler
+def handle_teacher_role(user_id):
+    """Выбор роли педагога"""
+    with state_lock:
+        user_states[user_id] = {
+            'state': UserState.TEACHER_ENTER_PASSWORD,
+            'role': 'teacher'
+        }
+    send_message(user_id, "👩‍🏫 Введите пароль учётной записи педагога:")
+
+@timed_handler
+def handle_role_selection(user_id, normalized, user_info):
+    """Ввод, не совпавший с кнопками роли"""
+    if not handle_typed_command(user_id, normalized, user_info):
         send_message(user_id,
                     "❌ Пожалуйста, выберите роль с помощью кнопок:",
-                    create_role_keyboard())
+                    ROLE_KEYBOARD)
 
-def handle_parent_group(user_id, text):
-    """Обработка выбора группы родителем"""
-    if text in GROUPS:
-        with state_lock:
-            user_states[user_id]['group'] = text
-            user_states[user_id]['state'] = UserState.PARENT_ENTER_DATE
-        
-        send_message(user_id,
-                    f"✅ Отлично, группа '{text}' выбрана!\n\n"
-                    "Теперь напишите дату проведения данного этапа в формате 'дд.мм.гггг' (например, 01.12.2025):")
-    
-    elif text == '🔙 Назад':
-        with state_lock:
-            user_states[user_id] = {'state': UserState.CHOOSE_ROLE}
-        send_message(user_id, "Выберите вашу роль:", create_role_keyboard())
+@timed_handler
+def handle_parent_group(user_id, group):
+    """Выбор группы родителем (group - название из GROUPS)"""
+    with state_lock:
+        user_states[user_id]['group'] = group
+        user_states[user_id]['state'] = UserState.PARENT_ENTER_DATE
     
-    else:
+    send_message(user_id,
+                f"✅ Отлично, группа '{group}' выбрана!\n\n"
+                "Теперь напишите дату проведения данного этапа в формате 'дд.мм.гггг' (например, 01.12.2025):")
+
+@timed_handler
+def handle_parent_group_input(user_id, normalized, user_info):
+    """Ввод, не совпавший ни с одной группой"""
+    if not handle_typed_command(user_id, normalized, user_info):
         send_message(user_id,
                     "❌ Пожалуйста, выберите группу из списка:",
-                    create_groups_keyboard())
+                    GROUPS_KEYBOARD)
 
-def handle_parent_date(user_id, text):
+@timed_handler
+def handle_parent_date(user_id, normalized, user_info):
     """Обработка даты от родителя"""
-    if text == '🔙 Назад':
-        with state_lock:
-            user_states[user_id]['state'] = UserState.PARENT_CHOOSE_GROUP
-        send_message(user_id, "Выберите группу:", create_groups_keyboard())
-        return
-    
-    is_valid, message = validate_date(text)
+    is_valid, message = validate_date(normalized)
     if is_valid:
         with state_lock:
-            user_states[user_id]['date'] = text
+            user_states[user_id]['date'] = normalized
             user_states[user_id]['state'] = UserState.PARENT_ENTER_NAME
         
         send_message(user_id, "📅 Дата сохранена! Теперь укажите имя и фамилию ребёнка:")
-    else:
+    elif not handle_typed_command(user_id, normalized, user_info):
         send_message(user_id, message)
 
-def handle_parent_name(user_id, text):
+@timed_handler
+def handle_parent_name(user_id, text, normalized, user_info):
     """Обработка имени ребенка"""
-    if text == '🔙 Назад':
-        with state_lock:
-            user_states[user_id]['state'] = UserState.PARENT_ENTER_DATE
-        send_message(user_id, "Введите дату проведения этапа (дд.мм.гггг):")
+    # «Рестарт» или «Начать ещё раз» прошли бы проверку как имя, поэтому здесь
+    # команды проверяются до проверки имени, а не только для отклонённого ввода
+    if handle_typed_command(user_id, normalized, user_info):
         return
     
     is_valid, message = validate_name(text)
@@ -452,9 +2120,12 @@ def handle_parent_name(user_id, text):
     else:
         send_message(user_id, message)
 
-def handle_parent_video(user_id, attachments, user_info):
+@timed_handler
+def handle_parent_video(user_id, normalized, attachments, user_info):
     """Обработка видео от родителя"""
     if not is_video_attachment(attachments):
+        if handle_typed_command(user_id, normalized, user_info):
+            return
         send_message(user_id,
                     "❌ Видео не обнаружено. Пожалуйста, прикрепите видеофайл к сообщению.\n\n"
                     "📹 **Как отправить видео:**\n"
@@ -467,7 +2138,7 @@ def handle_parent_video(user_id, attachments, user_info):
     if video_attachment:
         # Сохраняем заявку в базу данных
         with state_lock:
-            user_data = user_states[user_id]
+            user_data = dict(user_states[user_id])
         
         success = save_submission(
             user_id=user_id,
@@ -485,84 +2156,227 @@ def handle_parent_video(user_id, attachments, user_info):
                         f"• Ребёнок: {user_data['child_name']}\n"
                         f"• Группа: {user_data['group']}\n"
                         f"• Дата: {user_data['date']}",
-                        create_restart_keyboard())
+                        RESTART_KEYBOARD)
         else:
             send_message(user_id,
                         "❌ Ошибка сохранения. Попробуйте еще раз.",
-                        create_restart_keyboard())
+                        RESTART_KEYBOARD)
         
         reset_user_state(user_id)
     else:
         send_message(user_id,
                     "❌ Ошибка обработки видео. Попробуйте отправить видео еще раз.")
 
-def handle_teacher_password(user_id, text):
+@timed_handler
+def handle_teacher_password(user_id, text, normalized, user_info):
     """Обработка пароля педагога"""
-    if text == '🔙 Назад':
-        with state_lock:
-            user_states[user_id] = {'state': UserState.CHOOSE_ROLE}
-        send_message(user_id, "Выберите вашу роль:", create_role_keyboard())
-        return
-    
     if text == PASSWORD:
         with state_lock:
             user_states[user_id]['state'] = UserState.TEACHER_ENTER_DATE
         
         send_message(user_id,
                     "✅ Успешно! Теперь укажите дату этапа, с которого вы хотите получить материалов "
-                    "(в формате дд.мм.гггг):")
-    else:
+                    "(в формате дд.мм.гггг) или период (дд.мм.гггг-дд.мм.гггг). "
+                    "Чтобы получить материалы одной группы, добавьте её название: 01.12.2025 Земля")
+    elif not handle_typed_command(user_id, normalized, user_info):
         send_message(user_id,
                     "❌ Неверный пароль. Попробуйте еще раз или вернитесь назад.",
-                    create_role_keyboard())
+                    ROLE_KEYBOARD)
 
-def handle_teacher_date(user_id, text):
-    """Обработка даты для педагога"""
-    if text == '🔙 Назад':
-        with state_lock:
-            user_states[user_id]['state'] = UserState.TEACHER_ENTER_PASSWORD
-        send_message(user_id, "Введите пароль педагога:")
-        return
+def deliver_submissions_single(user_id, submissions):
+    """Пересылка материалов по одному видео в сообщении"""
+    sent_count = 0
+    for submission in submissions:
+        child_name, video_attachment, group_name, user_name = submission
+        message_text = (f"👶 **{child_name}**\n"
+                      f"🏫 Группа: {group_name}\n"
+                      f"👤 От: {user_name or 'Неизвестно'}")
+        
+        try:
+            # Отправляем сообщение с именем и видео; темп задаёт планировщик запросов
+            if send_message(user_id, message_text, attachment=video_attachment, priority=Priority.BULK):
+                sent_count += 1
+        except Exception as e:
+            logger.error(f"❌ Ошибка отправки материала: {e}")
+    return sent_count
+
+def deliver_submissions_batched(user_id, submissions, numbering_offset=0):
+    """Пересылка материалов пачками до MAX_ATTACHMENTS_PER_MESSAGE видео в сообщении"""
+    sent_count = 0
+    for start in range(0, len(submissions), MAX_ATTACHMENTS_PER_MESSAGE):
+        batch = submissions[start:start + MAX_ATTACHMENTS_PER_MESSAGE]
+        
+        # Подпись: по строке на каждое видео в порядке вложений (нумерация - сквозная по страницам)
+        lines = [
+            f"{numbering_offset + start + i}. {child_name} | {group_name} | от: {user_name or 'Неизвестно'}"
+            for i, (child_name, _, group_name, user_name) in enumerate(batch, 1)
+        ]
+        attachments = ','.join(submission[1] for submission in batch)
+        
+        try:
+            if send_message(user_id, '\n'.join(lines), attachment=attachments, priority=Priority.BULK):
+                sent_count += len(batch)
+        except Exception as e:
+            logger.error(f"❌ Ошибка отправки материалов: {e}")
+    return sent_count
+
+# Запрос педагога: дата или период, за которыми может идти название группы
+TEACHER_QUERY = re.compile(r'(?P<dates>[\d.\s-]*)(?P<group>.*)')
+
+@timed_handler
+def handle_teacher_date(user_id, normalized, user_info):
+    """Обработка даты (или периода 'дд.мм.гггг-дд.мм.гггг') и необязательной группы для педагога"""
+    query = TEACHER_QUERY.match(normalized)
+    group_text = query.group('group').strip()
+    date_from, _, date_to = (part.strip() for part in query.group('dates').strip().partition('-'))
+    is_valid, message = validate_date(date_from)
+    if is_valid and date_to:
+        is_valid, message = validate_date(date_to)
+    group_name = GROUPS_BY_NAME.get(group_text)
+    if is_valid and group_text and group_name is None:
+        is_valid, message = False, f"❌ Группа «{group_text}» не найдена. Доступные группы: {', '.join(GROUPS)}"
     
-    is_valid, message = validate_date(text)
     if is_valid:
-        # Ищем все заявки за указанную дату
-        target_date = text
-        found_submissions = get_submissions_by_date(target_date)
+        period_text = f"период {date_from} - {date_to}" if date_to else f"дату {date_from}"
+        if group_name:
+            period_text += f" в группе {group_name}"
+        date_to = date_to or date_from
+        total = count_submissions(date_from, date_to, group_name)
         
-        if found_submissions:
-            send_message(user_id,
-                        f"📦 Найдено {len(found_submissions)} материалов за дату {target_date}:")
-            
-            # Пересылаем каждую заявку
-            sent_count = 0
-            for submission in found_submissions:
-                child_name, video_attachment, group_name, user_name = submission
-                message_text = (f"👶 **{child_name}**\n"
-                              f"🏫 Группа: {group_name}\n"
-                              f"👤 От: {user_name or 'Неизвестно'}")
-                
-                try:
-                    # Отправляем сообщение с именем и видео
-                    if send_message(user_id, message_text, attachment=video_attachment):
-                        sent_count += 1
-                    time.sleep(0.5)  # Задержка между отправками
-                except Exception as e:
-                    logger.error(f"❌ Ошибка отправки материала: {e}")
-            
-            send_message(user_id,
-                        f"✅ Готово! Обработано {sent_count} из {len(found_submissions)} материалов.",
-                        create_teacher_restart_keyboard())
+        if total:
+            send_message(user_id, f"📦 Найдено {total} материалов за {period_text}:")
+            # Курсор выдачи хранится в сессии: следующие страницы - по кнопке
+            with state_lock:
+                user_states[user_id].update({
+                    'state': UserState.TEACHER_BROWSE,
+                    'date_from': date_from,
+                    'date_to': date_to,
+                    'group': group_name,
+                    'cursor': None,
+                    'shown': 0,
+                    'delivered': 0,
+                    'total': total
+                })
+            deliver_teacher_page(user_id)
         else:
             send_message(user_id,
-                        f"❌ Материалы за дату {target_date} не найдены.",
-                        create_teacher_restart_keyboard())
-        
-        reset_user_state(user_id)
-    else:
+                        f"❌ Материалы за {period_text} не найдены.",
+                        TEACHER_RESTART_KEYBOARD)
+            reset_user_state(user_id)
+    elif not handle_typed_command(user_id, normalized, user_info):
         send_message(user_id, message)
 
+def deliver_teacher_page(user_id):
+    """Выдача педагогу следующей страницы материалов по курсору из сессии"""
+    with state_lock:
+        session = dict(user_states[user_id])
+    
+    rows, next_cursor = get_submissions_page(session['date_from'], session['date_to'],
+                                             session.get('group'), after=session['cursor'])
+    submissions = [row[:4] for row in rows]
+    if TEACHER_DELIVERY_MODE == 'single':
+        sent_count = deliver_submissions_single(user_id, submissions)
+    else:
+        sent_count = deliver_submissions_batched(user_id, submissions, session['shown'])
+    
+    shown = session['shown'] + len(rows)
+    delivered = session['delivered'] + sent_count
+    if next_cursor is None:
+        send_message(user_id,
+                    f"✅ Готово! Обработано {delivered} из {session['total']} материалов.",
+                    TEACHER_RESTART_KEYBOARD)
+        reset_user_state(user_id)
+        return
+    
+    with state_lock:
+        user_states[user_id].update({'cursor': next_cursor, 'shown': shown, 'delivered': delivered})
+    send_message(user_id,
+                f"📄 Показано {shown} из {session['total']}. Нажмите «Показать ещё», "
+                "чтобы получить следующие материалы, или введите другую дату.",
+                TEACHER_MORE_KEYBOARD)
+
 # ========== ГЛАВНЫЙ ОБРАБОТЧИК ==========
+# Команды, набранные вручную: ищем ключевые слова внутри текста
+COMMAND_KEYWORDS = re.compile(r'(?P<settings>настройк|⚙️)|(?P<restart>начать ещё раз|рестарт|сначала)')
+
+def normalize_input(text):
+    """Единая нормализация ввода перед маршрутизацией"""
+    return (text or '').strip().lower()
+
+def handle_typed_command(user_id, normalized, user_info):
+    """Глобальная команда, набранная вручную (True - команда выполнена).
+
+    Кнопки находятся в TRANSITIONS за O(1); поиск ключевых слов - запасной
+    путь для ввода, который не подошёл текущему состоянию.
+    """
+    match = COMMAND_KEYWORDS.search(normalized)
+    if not match:
+        return False
+    if match.group('settings'):
+        handle_settings(user_id)
+    else:
+        handle_main_menu(user_id, user_info)
+    return True
+
+@timed_handler
+def handle_unknown_state(user_id, text, normalized, attachments, user_info):
+    """Если состояние неизвестно - начинаем сначала"""
+    send_message(user_id,
+                "Не понимаю команду. Давайте начнем сначала:",
+                START_KEYBOARD)
+
+def main_menu_transition(uid, text, norm, att, info):
+    """Переход в главное меню (кнопки «Старт», «Рестарт», «Назад»)"""
+    handle_main_menu(uid, info)
+
+def group_transition(group):
+    """Переход по кнопке группы: в обработчик передаётся название как в GROUPS"""
+    return lambda uid, text, norm, att, info: handle_parent_group(uid, group)
+
+# Таблица переходов: (состояние, нормализованный текст кнопки) -> обработчик.
+# ANY_STATE - переход доступен из любого состояния
+ANY_STATE = None
+TRANSITIONS = {
+    (ANY_STATE, 'старт'): main_menu_transition,
+    (ANY_STATE, '⚙️ настройки'): lambda uid, text, norm, att, info: handle_settings(uid),
+    (ANY_STATE, '🔄 начать ещё раз'): main_menu_transition,
+    (ANY_STATE, '🔄 рестарт'): main_menu_transition,
+    (ANY_STATE, '🔙 назад'): main_menu_transition,
+    (UserState.CHOOSE_MODE, '🤖 общаться с ботом'): lambda uid, text, norm, att, info: handle_bot_mode(uid, info),
+    (UserState.CHOOSE_MODE, '🤖 режим бота'): lambda uid, text, norm, att, info: handle_bot_mode(uid, info),
+    (UserState.CHOOSE_MODE, '💬 писать сообщения'): lambda uid, text, norm, att, info: handle_messages_mode(uid),
+    (UserState.CHOOSE_MODE, '💬 обычные сообщения'): lambda uid, text, norm, att, info: handle_messages_mode(uid),
+    (UserState.CHOOSE_ROLE, 'родитель'): lambda uid, text, norm, att, info: handle_parent_role(uid, info),
+    (UserState.CHOOSE_ROLE, 'педагог'): lambda uid, text, norm, att, info: handle_teacher_role(uid),
+    (UserState.TEACHER_BROWSE, f'▶️ показать ещё {TEACHER_PAGE_SIZE}'):
+        lambda uid, text, norm, att, info: deliver_teacher_page(uid),
+}
+TRANSITIONS.update({(UserState.PARENT_CHOOSE_GROUP, group.lower()): group_transition(group) for group in GROUPS})
+
+# Ввод, не совпавший ни с одной кнопкой: состояние -> обработчик
+STATE_HANDLERS = {
+    UserState.CHOOSE_MODE: lambda uid, text, norm, att, info: handle_mode_selection(uid, norm, info),
+    UserState.CHOOSE_ROLE: lambda uid, text, norm, att, info: handle_role_selection(uid, norm, info),
+    UserState.PARENT_CHOOSE_GROUP: lambda uid, text, norm, att, info: handle_parent_group_input(uid, norm, info),
+    UserState.PARENT_ENTER_DATE: lambda uid, text, norm, att, info: handle_parent_date(uid, norm, info),
+    UserState.PARENT_ENTER_NAME: lambda uid, text, norm, att, info: handle_parent_name(uid, text, norm, info),
+    UserState.PARENT_SEND_VIDEO: lambda uid, text, norm, att, info: handle_parent_video(uid, norm, att, info),
+    UserState.TEACHER_ENTER_PASSWORD: lambda uid, text, norm, att, info: handle_teacher_password(uid, text, norm, info),
+    UserState.TEACHER_ENTER_DATE: lambda uid, text, norm, att, info: handle_teacher_date(uid, norm, info),
+    # После страницы материалов педагог может сразу ввести другую дату
+    UserState.TEACHER_BROWSE: lambda uid, text, norm, att, info: handle_teacher_date(uid, norm, info),
+}
+
+def route_message(current_state, normalized):
+    """Выбор обработчика для нормализованного сообщения в текущем состоянии"""
+    # Любое сообщение в начальном состоянии открывает главное меню
+    if current_state == UserState.START:
+        return main_menu_transition
+    return (TRANSITIONS.get((current_state, normalized))
+            or TRANSITIONS.get((ANY_STATE, normalized))
+            or STATE_HANDLERS.get(current_state, handle_unknown_state))
+
+@timed_handler
 def handle_message(user_id, text, attachments, user_info):
     """Основной обработчик сообщений"""
     try:
@@ -571,82 +2385,196 @@ def handle_message(user_id, text, attachments, user_info):
         
         # Если пользователь не в режиме бота, просто выходим (сообщение пойдет админам)
         if not use_bot:
-            logger.info(f"💬 Сообщение от {get_user_display_name(user_id, user_info)} в обычном режиме: {text}")
+            logger.info("💬 Сообщение от %s в обычном режиме: %s", LazyDisplayName(user_id, user_info), text,
+                        extra={'rate_limited': True})
             return
 
         # Получаем текущее состояние пользователя
         with state_lock:
             current_state = user_states.get(user_id, {}).get('state', UserState.START)
+            session_expired = user_id not in user_states and user_states.pop_expired(user_id)
+
+        if session_expired:
+            send_message(user_id,
+                        "⌛ Вы давно не отвечали, и незаконченный диалог был сброшен. "
+                        "Давайте начнём заново - данные нужно будет ввести ещё раз.")
         
         # Логируем входящее сообщение
-        logger.info(f"🤖 Сообщение от {get_user_display_name(user_id, user_info)}: {text}")
-        
-        # Обработка команды "Старт" или любого сообщения если состояние START
-        if text.lower() == 'старт' or current_state == UserState.START:
-            handle_main_menu(user_id, user_info)
-            return
-        
-        # Обработка настроек
-        if 'настройк' in text.lower() or '⚙️' in text:
-            handle_settings(user_id)
-            return
-        
-        # Обработка команды "Начать ещё раз" или "Рестарт"
-        if any(word in text.lower() for word in ['начать ещё раз', 'рестарт', 'сначала']):
-            handle_main_menu(user_id, user_info)
-            return
-        
-        # Обработка "Назад"
-        if text == '🔙 Назад':
-            handle_main_menu(user_id, user_info)
-            return
+        logger.info("🤖 Сообщение от %s: %s", LazyDisplayName(user_id, user_info), text,
+                    extra={'rate_limited': True})
         
-        # Обработка по состояниям
-        if current_state == UserState.CHOOSE_MODE:
-            handle_mode_selection(user_id, text, user_info)
-        
-        elif current_state == UserState.CHOOSE_ROLE:
-            handle_role_selection(user_id, text, user_info)
-        
-        elif current_state == UserState.PARENT_CHOOSE_GROUP:
-            handle_parent_group(user_id, text)
-        
-        elif current_state == UserState.PARENT_ENTER_DATE:
-            handle_parent_date(user_id, text)
-        
-        elif current_state == UserState.PARENT_ENTER_NAME:
-            handle_parent_name(user_id, text)
-        
-        elif current_state == UserState.PARENT_SEND_VIDEO:
-            handle_parent_video(user_id, attachments, user_info)
-        
-        elif current_state == UserState.TEACHER_ENTER_PASSWORD:
-            handle_teacher_password(user_id, text)
-        
-        elif current_state == UserState.TEACHER_ENTER_DATE:
-            handle_teacher_date(user_id, text)
-        
-        else:
-            # Если состояние неизвестно - начинаем сначала
-            send_message(user_id,
-                        "Не понимаю команду. Давайте начнем сначала:",
-                        create_start_keyboard())
+        normalized = normalize_input(text)
+        handler = route_message(current_state, normalized)
+        handler(user_id, text, normalized, attachments, user_info)
     
     except Exception as e:
         logger.error(f"❌ Критическая ошибка обработки сообщения: {e}")
         send_message(user_id,
                     "⚠️ Произошла ошибка. Давайте начнем заново.",
-                    create_start_keyboard())
+                    START_KEYBOARD)
         reset_user_state(user_id)
 
+def process_event(user_id, event):
+    """Обработка одного события MESSAGE_NEW (выполняется в потоке диспетчера)"""
+    try:
+        text = event.message.text
+        attachments = event.message.attachments
+
+        # Профиль не запрашиваем заранее: имя загружается через кэш, когда оно нужно
+        handle_message(user_id, text, attachments, None)
+
+    except Exception as e:
+        logger.error(f"❌ Ошибка обработки события: {e}")
+        try:
+            send_message(user_id,
+                        "⚠️ Произошла ошибка. Давайте начнем заново.",
+                        START_KEYBOARD)
+        except:
+            pass
+    finally:
+        # Состояние могло измениться - сохраним его при следующем сбросе
+        session_store.mark_dirty(user_id)
+
+# ========== ДИСПЕТЧЕР СОБЫТИЙ ==========
+class EventDispatcher:
+    """Пул обработчиков событий.
+
+    События одного пользователя обрабатываются строго по порядку и никогда
+    одновременно, события разных пользователей - параллельно в WORKER_COUNT потоках.
+    Общее число ожидающих событий ограничено queue_size: при переполнении
+    submit() блокирует цикл longpoll, пока обработчики не освободятся.
+    """
+
+    def __init__(self, handler, workers=WORKER_COUNT, queue_size=WORKER_QUEUE_SIZE):
+        self.handler = handler
+        self._pending = {}  # user_id -> очередь событий пользователя
+        self._lock = Lock()
+        self._drained = Condition(self._lock)  # все принятые события обработаны
+        self._ready = Queue()  # пользователи, события которых можно обрабатывать
+        self._slots = BoundedSemaphore(queue_size)
+        self._threads = []
+        for i in range(workers):
+            thread = Thread(target=self._worker, name=f'bot-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, user_id, event, block=True, on_done=None):
+        """Постановка события в очередь пользователя.
+
+        При block=False и переполненной очереди возвращает False, не дожидаясь места.
+        on_done вызывается после обработки события (в том числе с ошибкой).
+        """
+        if not self._slots.acquire(blocking=block):
+            return False
+        with self._lock:
+            pending = self._pending.get(user_id)
+            if pending is not None:
+                # Пользователь уже обрабатывается или ждёт обработчика
+                pending.append((time.monotonic(), event, on_done))
+                return True
+            self._pending[user_id] = deque([(time.monotonic(), event, on_done)])
+        self._ready.put(user_id)
+        return True
+
+    def _worker(self):
+        while True:
+            user_id = self._ready.get()
+            if user_id is None:
+                return
+
+            with self._lock:
+                queued_at, event, on_done = self._pending[user_id].popleft()
+            EVENT_QUEUE_LAG.observe(time.monotonic() - queued_at)
+
+            try:
+                self.handler(user_id, event)
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработчика событий: {e}")
+            finally:
+                if on_done:
+                    on_done()
+                self._slots.release()
+                with self._lock:
+                    has_more = bool(self._pending[user_id])
+                    if not has_more:
+                        del self._pending[user_id]
+                        if not self._pending:
+                            self._drained.notify_all()
+                # Следующее событие пользователя - в конец общей очереди,
+                # чтобы один активный пользователь не занимал поток целиком
+                if has_more:
+                    self._ready.put(user_id)
+
+    def pending_count(self):
+        """Количество событий, ожидающих обработки"""
+        with self._lock:
+            return sum(len(events) for events in self._pending.values())
+
+    def stop(self, timeout=WORKER_STOP_TIMEOUT):
+        """Остановка обработчиков после обработки всех принятых событий.
+
+        Если не успели за timeout, необработанные события longpoll придут
+        повторно после перезапуска: их ts ещё не сохранён.
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            self._drained.wait_for(lambda: not self._pending, timeout)
+            lost = sum(len(events) for events in self._pending.values())
+        if lost:
+            logger.warning(f"⚠️ Остановка по таймауту: {lost} событий будут получены повторно после перезапуска")
+        for _ in self._threads:
+            self._ready.put(None)
+        for thread in self._threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+
+class RecentEvents:
+    """Ограниченный набор последних событий для отбрасывания повторной доставки"""
+
+    def __init__(self, capacity=EVENT_DEDUP_SIZE):
+        self.capacity = capacity
+        self._keys = OrderedDict()
+        self._lock = Lock()  # события приходят и из longpoll, и из потоков веб-сервера
+
+    @staticmethod
+    def event_key(event):
+        """event_id из longpoll, а для старых версий API - номер сообщения в диалоге"""
+        event_id = event.raw.get('event_id')
+        if event_id:
+            return event_id
+        return (event.message.peer_id, event.message.conversation_message_id)
+
+    def seen(self, event):
+        """True, если событие уже встречалось; иначе запоминает его"""
+        key = self.event_key(event)
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                DUPLICATE_EVENTS.inc()
+                return True
+            self._keys[key] = None
+            if len(self._keys) > self.capacity:
+                self._keys.popitem(last=False)
+        return False
+
+    def forget(self, event):
+        """Событие не принято в обработку - повторную доставку нужно принять"""
+        with self._lock:
+            self._keys.pop(self.event_key(event), None)
+
+# Обработчики событий и недавние события - общие для longpoll и Callback API
+event_dispatcher = None
+recent_events = RecentEvents()
+
 # ========== ВЕБ-СЕРВЕР ДЛЯ PING ==========
-app = Flask(__name__)
+# Маршруты регистрируются на blueprint, само приложение Flask создаёт create_app()
+web = Blueprint('web', __name__)
 
-@app.route('/')
+@web.route('/')
 def home():
     """Главная страница статуса бота"""
     try:
-        submissions_count = len(get_submissions_by_date(datetime.datetime.now().strftime('%d.%m.%Y')))
+        today = datetime.datetime.now().strftime('%Y-%m-%d')
+        submissions_count = stats_snapshot.get()['by_date'].get(today, 0)
     except:
         submissions_count = 0
         
@@ -665,52 +2593,47 @@ def home():
             <p>Время сервера: {datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}</p>
             <p>Статус: <span class="status">🟢 Активен</span></p>
             <p>Заявок сегодня: {submissions_count}</p>
-            <p><a href="/health">Проверка здоровья</a> | <a href="/stats">Статистика</a> | <a href="/backup">Создать бэкап</a></p>
+            <p><a href="/health">Проверка здоровья</a> | <a href="/stats">Статистика</a> | <a href="/metrics">Метрики</a> | <a href="/backup">Создать бэкап</a></p>
         </body>
     </html>
     """
 
-@app.route('/health')
+@web.route('/health')
 def health():
-    """Проверка здоровья бота"""
+    """Проверка здоровья бота (отвечает сразу, ещё до подключения к VK)"""
     return "OK"
 
-@app.route('/stats')
+@web.route('/ready')
+def ready():
+    """Готовность: 200 после завершения запуска, до этого 503"""
+    if startup.is_ready:
+        return "READY"
+    return "STARTING", 503
+
+@web.route('/stats')
 def stats():
     """Статистика бота"""
     try:
-        with db_lock:
-            cursor = db_connection.cursor()
-            cursor.execute('SELECT COUNT(*) FROM submissions')
-            total_submissions = cursor.fetchone()[0]
-            
-            cursor.execute('SELECT COUNT(*) FROM user_settings')
-            total_users = cursor.fetchone()[0]
-            
-            cursor.execute('SELECT COUNT(*) FROM user_settings WHERE use_bot = FALSE')
-            message_mode_users = cursor.fetchone()[0]
-            
-            # Последние 5 заявок
-            cursor.execute('''
-                SELECT child_name, group_name, date, created_at 
-                FROM submissions 
-                ORDER BY created_at DESC 
-                LIMIT 5
-            ''')
-            recent_submissions = cursor.fetchall()
+        snapshot = stats_snapshot.get()
         
         stats_data = {
             'status': 'active',
-            'total_submissions': total_submissions,
-            'total_users': total_users,
-            'message_mode_users': message_mode_users,
+            'total_submissions': snapshot['total_submissions'],
+            'total_users': snapshot['total_users'],
+            'message_mode_users': snapshot['message_mode_users'],
+            'bot_mode_users': snapshot['bot_mode_users'],
+            'submissions_by_group': snapshot['by_group'],
+            'submissions_by_date': snapshot['by_date'],
+            'profile_cache': profile_cache.stats(),
+            'db_write_lock': db.lock_stats(),
+            'startup': startup.status(),
             'recent_submissions': [
                 {
                     'child_name': sub[0],
                     'group': sub[1],
                     'date': sub[2],
                     'time': sub[3]
-                } for sub in recent_submissions
+                } for sub in snapshot['recent_submissions']
             ],
             'timestamp': datetime.datetime.now().isoformat()
         }
@@ -719,116 +2642,480 @@ def stats():
     except Exception as e:
         return json.dumps({'error': str(e)})
 
-@app.route('/backup')
+def count_active_sessions():
+    with state_lock:
+        return len(user_states)
+
+ACTIVE_SESSIONS.set_function(count_active_sessions)
+SUBMISSIONS_BY_GROUP.set_function(lambda: stats_snapshot.get()['by_group'])
+
+@web.route('/metrics')
+def metrics():
+    """Метрики в формате Prometheus"""
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@web.route('/backup')
 def create_backup():
-    """Создание резервной копии базы данных"""
+    """Запуск резервного копирования в фоне"""
+    started = backup_job.start()
+    status = backup_job.status()
+    status['message'] = "✅ Бэкап запущен" if started else "⏳ Бэкап уже выполняется"
+    return json.dumps(status, ensure_ascii=False, indent=2)
+
+@web.route('/backup/status')
+def backup_status():
+    """Ход выполнения резервного копирования"""
+    return json.dumps(backup_job.status(), ensure_ascii=False, indent=2)
+
+# ========== ВЫГРУЗКА ЗАЯВОК ==========
+EXPORT_COLUMNS = ('id', 'date', 'group_name', 'child_name', 'user_id', 'user_name',
+                  'video_attachment', 'video_url', 'created_at')
+
+def parse_export_date(text):
+    """Дата фильтра выгрузки: 'дд.мм.гггг' или 'гггг-мм-дд' -> 'гггг-мм-дд'"""
+    iso = to_iso_date(text)
+    if iso:
+        return iso
     try:
-        backup_database()
-        return "✅ Бэкап создан успешно!"
-    except Exception as e:
-        return f"❌ Ошибка создания бэкапа: {e}"
+        return datetime.datetime.strptime(text, '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f'неверная дата {text}, нужен формат дд.мм.гггг')
+
+def export_query(date_from=None, date_to=None, group_name=None):
+    """SQL страницы выгрузки; параметры: [последний id] + params + [размер страницы]"""
+    conditions, params = ['id > ?'], []
+    if date_from:
+        conditions.append('date_iso >= ?')
+        params.append(date_from)
+    if date_to:
+        conditions.append('date_iso <= ?')
+        params.append(date_to)
+    if group_name:
+        conditions.append('group_name = ?')
+        params.append(group_name)
+    return f'''
+        SELECT id, date, group_name, child_name, user_id, user_name, video_attachment, created_at
+        FROM submissions
+        WHERE {' AND '.join(conditions)}
+        ORDER BY id
+        LIMIT ?
+    ''', params
+
+def iter_export_rows(date_from=None, date_to=None, group_name=None, after_id=0, limit=None,
+                     page_size=EXPORT_PAGE_SIZE):
+    """Заявки по возрастанию id страницами по ключу (id > последнего выданного).
+
+    Соединение из пула берётся только на время чтения страницы, поэтому
+    медленный клиент не занимает его, а память не зависит от объёма выгрузки.
+    """
+    sql, params = export_query(date_from, date_to, group_name)
+    remaining = limit
+    while remaining is None or remaining > 0:
+        count = page_size if remaining is None else min(page_size, remaining)
+        rows = db.fetchall(sql, [after_id] + params + [count])
+        for row in rows:
+            yield row
+        if len(rows) < count:
+            return
+        after_id = rows[-1][0]
+        if remaining is not None:
+            remaining -= len(rows)
+
+def format_export_rows(rows, export_format):
+    """Строки выгрузки в CSV (с заголовком) или NDJSON, по куску на страницу"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if export_format == 'csv' else None
+    if writer:
+        writer.writerow(EXPORT_COLUMNS)
+    for i, row in enumerate(rows, 1):
+        record = row[:7] + (f'https://vk.com/{row[6]}',) + row[7:]
+        if writer:
+            writer.writerow(record)
+        else:
+            buffer.write(json.dumps(dict(zip(EXPORT_COLUMNS, record)), ensure_ascii=False))
+            buffer.write('\n')
+        if i % EXPORT_PAGE_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def gzip_stream(chunks):
+    """Сжатие потока кусков в gzip на лету"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def export_authorized():
+    """Проверка токена выгрузки: заголовок 'Authorization: Bearer <токен>' или ?token="""
+    if not EXPORT_TOKEN:
+        return False
+    header = request.headers.get('Authorization', '')
+    token = header[7:] if header.startswith('Bearer ') else request.args.get('token', '')
+    return hmac.compare_digest(token.encode('utf-8'), EXPORT_TOKEN.encode('utf-8'))
+
+@web.route('/export')
+def export_submissions():
+    """Потоковая выгрузка заявок в CSV или NDJSON.
 
-def backup_database():
-    """Создание резервной копии базы данных"""
+    Параметры: format (csv/ndjson), date_from, date_to, group, after (id последней
+    полученной заявки - продолжение прерванной выгрузки), limit.
+    """
+    if not export_authorized():
+        return json.dumps({'error': 'unauthorized'}), 401, {'Content-Type': 'application/json'}
+    
+    args = request.args
+    export_format = args.get('format', 'csv')
     try:
-        backup_dir = "backups"
-        
-        # Создаем папку для бэкапов если её нет
-        if not os.path.exists(backup_dir):
-            os.makedirs(backup_dir)
-        
-        # Имя файла с датой
-        backup_file = f"backup_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-        backup_path = os.path.join(backup_dir, backup_file)
-        
-        # Копируем базу данных
-        with db_lock:
-            shutil.copy2('bot_database.db', backup_path)
-        
-        logger.info(f"✅ Создан бэкап: {backup_file}")
-        
-        # Удаляем старые бэкапы (оставляем последние 5)
+        if export_format not in ('csv', 'ndjson'):
+            raise ValueError(f'неизвестный формат {export_format}')
+        date_from = parse_export_date(args['date_from']) if args.get('date_from') else None
+        date_to = parse_export_date(args['date_to']) if args.get('date_to') else None
+        group_name = args.get('group') or None
+        if group_name and group_name not in GROUPS_SET:
+            raise ValueError(f'неизвестная группа {group_name}')
+        after_id = int(args.get('after', 0))
+        limit = int(args['limit']) if args.get('limit') else None
+    except ValueError as e:
+        return json.dumps({'error': str(e)}, ensure_ascii=False), 400, {'Content-Type': 'application/json'}
+    
+    rows = iter_export_rows(date_from, date_to, group_name, after_id, limit)
+    chunks = format_export_rows(rows, export_format)
+    headers = {
+        'Content-Disposition': f'attachment; filename=submissions.{export_format}',
+        'X-Accel-Buffering': 'no'
+    }
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        body = gzip_stream(chunks)
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+    else:
+        body = (chunk.encode('utf-8') for chunk in chunks)
+    content_type = 'text/csv; charset=utf-8' if export_format == 'csv' else 'application/x-ndjson; charset=utf-8'
+    logger.info(f"📤 Выгрузка заявок: {export_format}, {date_from}..{date_to}, группа: {group_name}, после id {after_id}")
+    return Response(body, content_type=content_type, headers=headers)
+
+# ========== CALLBACK API ==========
+# /callback подключается только в процессе бота в режиме Callback API: без
+# обработчиков событий он отвечал бы 503 всегда, и VK отключил бы сервер
+callback_api = Blueprint('callback_api', __name__)
+
+@callback_api.route('/callback', methods=['POST'])
+def vk_callback():
+    """Приём событий Callback API: подтверждение сервера, проверка секрета, очередь.
+
+    Ответ 'ok' отправляется сразу после постановки события в очередь. Если
+    бот ещё запускается или очередь переполнена, отвечаем 503 - VK повторит
+    доставку позже.
+    """
+    data = request.get_json(silent=True) or {}
+    if str(data.get('group_id')) != str(GROUP_ID):
+        return 'wrong group', 403
+    
+    if data.get('type') == 'confirmation':
+        return CALLBACK_CONFIRMATION
+    
+    if CALLBACK_SECRET and not hmac.compare_digest(str(data.get('secret', '')).encode('utf-8'),
+                                                   CALLBACK_SECRET.encode('utf-8')):
+        logger.warning("⚠️ Callback API: неверный секретный ключ")
+        return 'forbidden', 403
+    
+    if data.get('type') != VkBotEventType.MESSAGE_NEW.value:
+        return 'ok'
+    if event_dispatcher is None:
+        return 'not ready', 503
+    
+    event = VkBotMessageEvent(data)
+    if recent_events.seen(event):
+        return 'ok'
+    profile_cache.prefetch([event.message.from_id])
+    if not event_dispatcher.submit(event.message.from_id, event, block=False):
+        recent_events.forget(event)
+        logger.warning("⚠️ Callback API: очередь событий переполнена, VK повторит доставку")
+        return 'busy', 503
+    return 'ok'
+
+# ========== РЕЗЕРВНОЕ КОПИРОВАНИЕ ==========
+def backup_database(progress=None):
+    """Создание резервной копии базы данных через online backup API SQLite.
+
+    Копирование идёт порциями по BACKUP_PAGES_PER_STEP страниц из открытой
+    транзакции чтения: в режиме WAL она не блокирует запись, а копия
+    соответствует одному согласованному снимку, включая данные из -wal файла.
+    """
+    # Создаем папку для бэкапов если её нет
+    if not os.path.exists(BACKUP_DIR):
+        os.makedirs(BACKUP_DIR)
+    
+    # Имя файла с датой
+    backup_file = f"backup_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
+    backup_path = os.path.join(BACKUP_DIR, backup_file)
+    
+    source = sqlite3.connect(f'file:{DB_PATH}?mode=ro', uri=True, timeout=30)
+    target = sqlite3.connect(backup_path)
+    try:
+        # Фиксируем снимок, чтобы запись во время копирования не перезапускала его
+        source.execute('BEGIN')
+        source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        source.backup(target, pages=BACKUP_PAGES_PER_STEP, progress=progress)
+        source.rollback()
+    finally:
+        target.close()
+        source.close()
+    
+    if BACKUP_COMPRESS:
+        with open(backup_path, 'rb') as src, gzip.open(backup_path + '.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(backup_path)
+        backup_file += '.gz'
+    
+    logger.info(f"✅ Создан бэкап: {backup_file}")
+    
+    # Удаляем старые бэкапы (оставляем последние BACKUP_KEEP)
+    try:
+        backup_files = sorted([f for f in os.listdir(BACKUP_DIR) if f.startswith('backup_')])
+        if len(backup_files) > BACKUP_KEEP:
+            for old_backup in backup_files[:-BACKUP_KEEP]:
+                os.remove(os.path.join(BACKUP_DIR, old_backup))
+                logger.info(f"🗑️ Удален старый бэкап: {old_backup}")
+    except Exception as e:
+        logger.error(f"❌ Ошибка очистки старых бэкапов: {e}")
+    
+    return backup_file
+
+class BackupJob:
+    """Фоновое резервное копирование: по запросу и по расписанию, не больше одного одновременно"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._state = {'state': 'idle'}
+
+    def _update(self, **fields):
+        with self._lock:
+            self._state.update(fields)
+
+    def status(self):
+        """Текущее состояние последнего запуска"""
+        with self._lock:
+            return dict(self._state)
+
+    def _progress(self, status, remaining, total):
+        done = total - remaining
+        self._update(pages_done=done, pages_total=total,
+                     progress=round(done / total * 100, 1) if total else 100.0)
+
+    def run(self):
+        """Синхронный запуск (в текущем потоке)"""
         try:
-            backup_files = sorted([f for f in os.listdir(backup_dir) if f.startswith('backup_')])
-            if len(backup_files) > 5:
-                for old_backup in backup_files[:-5]:
-                    os.remove(os.path.join(backup_dir, old_backup))
-                    logger.info(f"🗑️ Удален старый бэкап: {old_backup}")
+            backup_file = backup_database(progress=self._progress)
+            self._update(state='done', file=backup_file, progress=100.0,
+                         finished_at=datetime.datetime.now().isoformat())
         except Exception as e:
-            logger.error(f"❌ Ошибка очистки старых бэкапов: {e}")
-            
-    except Exception as e:
-        logger.error(f"❌ Ошибка создания бэкапа: {e}")
+            logger.error(f"❌ Ошибка создания бэкапа: {e}")
+            self._update(state='error', error=str(e),
+                         finished_at=datetime.datetime.now().isoformat())
+
+    def start(self):
+        """Запуск в фоновом потоке; False, если бэкап уже выполняется"""
+        with self._lock:
+            if self._state['state'] == 'running':
+                return False
+            self._state = {'state': 'running', 'progress': 0.0,
+                           'started_at': datetime.datetime.now().isoformat()}
+        Thread(target=self.run, name='backup', daemon=True).start()
+        return True
+
+    def _schedule(self, interval):
+        while True:
+            time.sleep(interval)
+            self.start()
+
+    def start_schedule(self, hours=BACKUP_INTERVAL_HOURS):
+        """Периодическое резервное копирование каждые hours часов"""
+        if hours > 0:
+            Thread(target=self._schedule, args=(hours * 3600,), name='backup-scheduler',
+                   daemon=True).start()
+            logger.info(f"🗄️ Автоматический бэкап каждые {hours} ч.")
+
+backup_job = BackupJob()
+
+web_server = None
+flask_app = None
+flask_app_lock = Lock()
+
+def create_app():
+    """Приложение Flask (создаётся один раз; для gunicorn - 'bot:create_app()')"""
+    global flask_app
+    with flask_app_lock:
+        if flask_app is None:
+            setup_logging()
+            flask_app = Flask(__name__)
+            flask_app.register_blueprint(web)
+            if VK_EVENTS_MODE == 'callback' and not WEB_READ_ONLY:
+                flask_app.register_blueprint(callback_api)
+            elif VK_EVENTS_MODE == 'callback':
+                logger.warning("⚠️ /callback не подключён: в режиме только чтения нет обработчиков событий, "
+                               "адрес Callback API должен указывать на процесс бота")
+    return flask_app
+
+def __getattr__(name):
+    # bot.app по-прежнему работает (gunicorn 'bot:app'), но приложение создаётся лениво
+    if name == 'app':
+        return create_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def run_web_server():
     """Запуск веб-сервера для мониторинга"""
+    global web_server
     try:
         port = int(os.environ.get('PORT', 5000))
+        app = create_app()
+        
+        if WEB_SERVER == 'waitress':
+            try:
+                from waitress import create_server
+            except ImportError:
+                logger.error("❌ waitress не установлен, используется встроенный сервер Flask")
+            else:
+                # Не больше WEB_THREADS запросов одновременно, остальные ждут в очереди
+                web_server = create_server(app, host='0.0.0.0', port=port,
+                                           threads=WEB_THREADS,
+                                           connection_limit=WEB_CONNECTION_LIMIT)
+                logger.info(f"🌐 waitress: порт {port}, потоков {WEB_THREADS}")
+                web_server.run()
+                return
+        
         app.run(host='0.0.0.0', port=port, debug=False)
     except Exception as e:
         logger.error(f"❌ Ошибка веб-сервера: {e}")
 
+def stop_web_server():
+    """Остановка веб-сервера (встроенный сервер Flask завершится вместе с процессом)"""
+    if web_server:
+        web_server.close()
+
+def handle_sigterm(signum, frame):
+    """SIGTERM (остановка на хостинге) - штатное завершение через finally"""
+    logger.info("⏹️ Получен SIGTERM, завершаем работу...")
+    sys.exit(0)
+
 # ========== ЗАПУСК БОТА ==========
-if __name__ == '__main__':
+def run_web():
+    """Только веб-сервер мониторинга, бот работает в другом процессе"""
+    setup_logging()
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    logger.info("🌐 Запуск веб-сервера мониторинга (только чтение БД)...")
+    startup.ready()
+    try:
+        run_web_server()
+    finally:
+        stop_web_server()
+        if db.initialized:
+            db.close()
+
+def run_longpoll(longpoll):
+    """Основной цикл Bots Long Poll с переподключением при ошибках"""
+    backoff = ReconnectBackoff()
+    while True:
+        try:
+            events = [event for event in longpoll.check()
+                      if event.type == VkBotEventType.MESSAGE_NEW and not recent_events.seen(event)]
+            backoff.reset()
+            
+            # Профили новых пользователей из одного ответа longpoll - одним фоновым запросом
+            profile_cache.prefetch(event.message.from_id for event in events)
+            
+            done = longpoll.track(len(events))
+            for event in events:
+                event_dispatcher.submit(event.message.from_id, event, on_done=done)
+            
+        except (requests.exceptions.RequestException, vk_api.exceptions.VkApiError, ValueError) as e:
+            # Сетевые ошибки, ошибки VK API и некорректный JSON: ts не меняли,
+            # поэтому после переподключения события не теряются
+            delay = backoff.next_delay()
+            logger.error(f"❌ Ошибка longpoll (попытка {backoff.attempt}), повтор через {delay:.2f} с: {e}")
+            time.sleep(delay)
+        except Exception as e:
+            delay = backoff.next_delay()
+            logger.error(f"❌ Общая ошибка в основном цикле, повтор через {delay:.2f} с: {e}")
+            time.sleep(delay)
+
+def run_bot():
+    """Запуск бота: веб-сервер, БД, VK API, кэши и получение событий (longpoll или Callback API)"""
+    global event_dispatcher
+    check_settings()
+    with startup.phase('логирование'):
+        setup_logging()
     logger.info("🚀 Запуск улучшенного бота...")
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    
+    # Веб-сервер - первым: /health отвечает, пока идёт остальная инициализация
+    with startup.phase('веб-сервер'):
+        web_thread = Thread(target=run_web_server, daemon=True)
+        web_thread.start()
+    logger.info("🌐 Веб-сервер запущен")
+    
+    with startup.phase('БД'):
+        db.get()
+        db_writer.get()
     
     try:
         # Инициализация VK API
-        vk_session = vk_api.VkApi(token=GROUP_TOKEN)
-        vk = vk_session.get_api()
-        longpoll = VkBotLongPoll(vk_session, GROUP_ID)
+        with startup.phase('VK API'):
+            longpoll = ResumableLongPoll(vk_session.get(), GROUP_ID) if VK_EVENTS_MODE == 'longpoll' else None
+            vk_scheduler.get()
         logger.info("✅ VK API инициализирован")
     except Exception as e:
         logger.error(f"❌ Ошибка инициализации VK API: {e}")
         sys.exit(1)
     
+    with startup.phase('кэши и сессии'):
+        warm_settings_cache()
+        session_store.restore()
+    session_store.start()
+    backup_job.start_schedule()
+    
     try:
-        # Запускаем веб-сервер в отдельном потоке
-        web_thread = Thread(target=run_web_server, daemon=True)
-        web_thread.start()
-        logger.info("🌐 Веб-сервер запущен")
-        
         logger.info("✅ Бот успешно запущен и ожидает сообщений...")
         logger.info(f"📊 Статистика доступна по /stats")
         
-        # Основной цикл бота с переподключением при ошибках
-        while True:
-            try:
-                for event in longpoll.listen():
-                    if event.type == VkBotEventType.MESSAGE_NEW:
-                        try:
-                            user_id = event.message.from_id
-                            text = event.message.text
-                            attachments = event.message.attachments
-                            
-                            # Получаем информацию о пользователе
-                            user_info = vk.users.get(user_ids=user_id, fields='first_name,last_name')[0]
-                            
-                            # Обрабатываем сообщение
-                            handle_message(user_id, text, attachments, user_info)
-                            
-                        except Exception as e:
-                            logger.error(f"❌ Ошибка обработки события: {e}")
-                            try:
-                                send_message(user_id,
-                                            "⚠️ Произошла ошибка. Давайте начнем заново.",
-                                            create_start_keyboard())
-                            except:
-                                pass
-                
-            except vk_api.exceptions.ApiError as e:
-                logger.error(f"❌ Ошибка VK API: {e}")
-                time.sleep(10)  # Ждем перед переподключением
-            except Exception as e:
-                logger.error(f"❌ Общая ошибка в основном цикле: {e}")
-                time.sleep(10)
+        # Обработчики событий: параллельно по пользователям, по порядку для каждого
+        event_dispatcher = EventDispatcher(process_event)
+        EVENT_QUEUE_DEPTH.set_function(event_dispatcher.pending_count)
+        logger.info(f"⚙️ Обработчиков событий: {WORKER_COUNT}, очередь: {WORKER_QUEUE_SIZE}")
+        startup.ready()
+        
+        if longpoll:
+            run_longpoll(longpoll)
+        else:
+            # События приходят на /callback веб-сервера, основной поток только ждёт остановки
+            logger.info("📨 Получение событий через Callback API (/callback)")
+            while web_thread.is_alive():
+                web_thread.join(1)
+            logger.error("❌ Веб-сервер остановился, Callback API недоступен")
     
     except KeyboardInterrupt:
         logger.info("⏹️ Бот остановлен пользователем")
     except Exception as e:
         logger.error(f"❌ Критическая ошибка бота: {e}")
     finally:
+        stop_web_server()
+        if event_dispatcher:
+            event_dispatcher.stop()
+        if vk_scheduler.initialized:
+            vk_scheduler.stop()
+        session_store.stop()
+        db_writer.stop()
         # Закрываем соединение с БД
-        if db_connection:
-            db_connection.close()
+        db.close()
         logger.info("🔚 Работа бота завершена")
+
+if __name__ == '__main__':
+    if WEB_READ_ONLY:
+        run_web()
+    else:
+        run_bot()
@@ -0,0 +1,486 @@
+"""Нагрузочный тест бота без обращения к настоящему VK.
+
+Поднимает локальный сервер, который имитирует Bots Long Poll и методы
+groups.getLongPollServer, messages.send, users.get и execute, запускает bot.py
+отдельным процессом с VK_API_URL на этот сервер и проводит родителей и педагогов
+через полные сценарии UserState. В конце печатает пропускную способность,
+задержку ответа (p50/p95/p99) и скорость записи заявок в БД.
+
+    python loadtest.py --parents 2000 --teachers 20 --latency 0.05 --error-rate 0.01
+
+С --callback события доставляются POST-запросами на /callback бота (Callback API)
+вместо longpoll.
+"""
+import argparse
+import datetime
+import heapq
+import json
+import os
+import random
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+from urllib.parse import parse_qs, urlparse
+
+# Импорт bot.py ничего не запускает: БД и сессия VK создаются лениво
+from bot import GROUPS
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+
+LONGPOLL_BATCH = 1000  # событий в одном ответе longpoll
+CALLBACK_SECRET = 'loadtest-secret'
+CALLBACK_SENDERS = 16  # одновременных POST-запросов на /callback
+
+def percentile(values, percent):
+    """Перцентиль по отсортированному списку (ближайший ранг)"""
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(percent / 100 * len(values))) - 1))
+    return values[index]
+
+# ========== ИМИТАЦИЯ VK ==========
+class FakeVk:
+    """Состояние поддельного VK: очередь событий longpoll и обработка методов API"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_code=10):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.url = None
+        self.on_reply = None  # вызывается для каждого messages.send: (user_id, текст)
+        self._events = []
+        self._events_cond = threading.Condition()
+        self._stats_lock = threading.Lock()
+        self.calls = {}
+        self.errors = 0
+        self.callback_url = None  # если задан - события отправляются на Callback API бота
+        self.callback_retries = 0
+        self._callback_queue = Queue()
+        self.connected = threading.Event()
+
+    def push_message(self, user_id, text, attachments=()):
+        """Новое входящее сообщение от пользователя (событие message_new)"""
+        with self._events_cond:
+            message_id = len(self._events) + 1
+            self._events.append({
+                'type': 'message_new',
+                'object': {
+                    'message': {
+                        'id': message_id,
+                        'date': int(time.time()),
+                        'peer_id': user_id,
+                        'from_id': user_id,
+                        'text': text,
+                        'attachments': list(attachments),
+                        'conversation_message_id': message_id
+                    },
+                    'client_info': {'keyboard': True, 'inline_keyboard': True}
+                },
+                'group_id': 1,
+                'event_id': uuid.uuid4().hex
+            })
+            self._events_cond.notify_all()
+            event = self._events[-1]
+        if self.callback_url:
+            self._callback_queue.put(dict(event, secret=CALLBACK_SECRET))
+
+    def start_callback_senders(self):
+        for _ in range(CALLBACK_SENDERS):
+            threading.Thread(target=self._callback_sender, daemon=True).start()
+
+    def _callback_sender(self):
+        """Доставка событий на /callback; как VK, повторяет при ответе не 'ok'"""
+        while True:
+            event = self._callback_queue.get()
+            body = json.dumps(event, ensure_ascii=False).encode('utf-8')
+            for attempt in range(5):
+                request = urllib.request.Request(self.callback_url, data=body,
+                                                 headers={'Content-Type': 'application/json'})
+                try:
+                    with urllib.request.urlopen(request, timeout=10) as response:
+                        if response.read() == b'ok':
+                            break
+                except (urllib.error.URLError, OSError):
+                    pass
+                with self._stats_lock:
+                    self.callback_retries += 1
+                time.sleep(0.2 * (attempt + 1))
+
+    def longpoll(self, ts, wait):
+        """Ответ a_check: события начиная с ts, ждём новых не дольше wait секунд"""
+        deadline = time.monotonic() + wait
+        with self._events_cond:
+            if ts > len(self._events):
+                # Как настоящий VK: ts из будущего (например, сохранённый ботом
+                # в прошлом запуске) - история устарела, продолжайте с текущего
+                return {'failed': 1, 'ts': str(len(self._events))}
+            while len(self._events) <= ts:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._events_cond.wait(remaining)
+            updates = self._events[ts:ts + LONGPOLL_BATCH]
+            return {'ts': str(ts + len(updates)), 'updates': updates}
+
+    def _count(self, method):
+        with self._stats_lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    def call(self, method, params):
+        """Выполнение одного метода API; возвращает (результат, ошибка)"""
+        self._count(method)
+        if method in ('messages.send', 'users.get') and random.random() < self.error_rate:
+            with self._stats_lock:
+                self.errors += 1
+            return None, {'error_code': self.error_code, 'error_msg': 'Injected error'}
+
+        if method == 'groups.getLongPollServer':
+            self.connected.set()
+            with self._events_cond:
+                ts = len(self._events)
+            return {'key': 'loadtest', 'server': f'{self.url}/lp', 'ts': str(ts)}, None
+        if method == 'users.get':
+            user_ids = str(params.get('user_ids', '')).split(',')
+            return [{'id': int(uid), 'first_name': 'Тест', 'last_name': str(uid)}
+                    for uid in user_ids if uid], None
+        if method == 'messages.send':
+            if self.on_reply:
+                self.on_reply(int(params['user_id']), str(params.get('message', '')))
+            return random.randint(1, 2 ** 31), None
+        if method == 'execute':
+            return self.execute(params['code'])
+        return None, {'error_code': 3, 'error_msg': f'Unknown method {method}'}
+
+    def execute(self, code):
+        """Разбор кода 'return [API.метод({...}), ...];' и выполнение вызовов по порядку"""
+        decoder = json.JSONDecoder()
+        results, errors = [], []
+        position = code.find('API.')
+        while position != -1:
+            start = position + len('API.')
+            bracket = code.index('(', start)
+            method = code[start:bracket]
+            params, end = decoder.raw_decode(code, bracket + 1)
+            result, error = self.call(method, params)
+            if error:
+                results.append(False)
+                errors.append(dict(error, method=method))
+            else:
+                results.append(result)
+            position = code.find('API.', end)
+        return {'response': results, 'execute_errors': errors}, None
+
+class FakeVkHandler(BaseHTTPRequestHandler):
+    """HTTP-обработчик: /method/<метод> и /lp (longpoll)"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _params(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length).decode('utf-8')
+            params.update({key: values[-1] for key, values in parse_qs(body).items()})
+        return url.path, params
+
+    def _handle(self):
+        fake = self.server.fake
+        path, params = self._params()
+        if path == '/lp':
+            self._reply(fake.longpoll(int(params.get('ts', 0)), min(float(params.get('wait', 25)), 25)))
+            return
+        if not path.startswith('/method/'):
+            self.send_error(404)
+            return
+
+        if fake.latency or fake.jitter:
+            time.sleep(fake.latency + random.uniform(0, fake.jitter))
+        result, error = fake.call(path[len('/method/'):], params)
+        if error:
+            self._reply({'error': dict(error, request_params=[])})
+        elif path.endswith('/execute'):
+            self._reply(result)
+        else:
+            self._reply({'response': result})
+
+    do_GET = _handle
+    do_POST = _handle
+
+# ========== СЦЕНАРИИ ПОЛЬЗОВАТЕЛЕЙ ==========
+class SimulatedUser:
+    """Пользователь, проходящий сценарий: отправляет шаг и ждёт ответа бота"""
+
+    def __init__(self, user_id, role, steps, final_markers=None):
+        self.user_id = user_id
+        self.role = role
+        self.steps = steps  # [(текст, вложения), ...]
+        self.final_markers = final_markers  # последний шаг ждёт ответа с одним из маркеров
+        self.step = 0
+        self.sent_at = None
+        self.got_first_reply = False
+        self.done = False
+        self.failed = False
+        self.lock = threading.Lock()
+
+class LoadTest:
+    """Запуск бота против FakeVk и прогон сценариев"""
+
+    def __init__(self, args):
+        self.args = args
+        self.fake = FakeVk(args.latency, args.jitter, args.error_rate, args.error_code)
+        self.fake.on_reply = self.on_reply
+        self.users = {}
+        self.latencies = []
+        self.retrievals = []
+        self._latency_lock = threading.Lock()
+        self._schedule = []
+        self._schedule_cond = threading.Condition()
+        self._finished = threading.Event()
+        self._remaining = 0
+        self._remaining_lock = threading.Lock()
+
+    # ----- планировщик отправки (разгон и пауза на раздумье) -----
+    def schedule(self, delay, user):
+        with self._schedule_cond:
+            heapq.heappush(self._schedule, (time.monotonic() + delay, user.user_id))
+            self._schedule_cond.notify()
+
+    def _scheduler(self):
+        while not self._finished.is_set():
+            with self._schedule_cond:
+                while not self._schedule:
+                    self._schedule_cond.wait(0.5)
+                    if self._finished.is_set():
+                        return
+                due, user_id = self._schedule[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self._schedule_cond.wait(delay)
+                    continue
+                heapq.heappop(self._schedule)
+            self.send_step(self.users[user_id])
+
+    # ----- сценарии -----
+    def build_users(self):
+        stage_date = (datetime.date.today() - datetime.timedelta(days=1)).strftime('%d.%m.%Y')
+        start = ('Старт', ())
+        bot_mode = ('🤖 Общаться с ботом', ())
+        for i in range(self.args.parents):
+            user_id = 100000 + i
+            video = [{'type': 'video', 'video': {'owner_id': user_id, 'id': i + 1}}]
+            self.users[user_id] = SimulatedUser(user_id, 'parent', [
+                start, bot_mode, ('Родитель', ()), (random.choice(GROUPS), ()),
+                (stage_date, ()), ('Тестовый Ребёнок', ()), ('', video)
+            ])
+        for i in range(self.args.teachers):
+            user_id = 900000 + i
+            self.users[user_id] = SimulatedUser(user_id, 'teacher', [
+                start, bot_mode, ('Педагог', ()), (self.args.password, ()), (stage_date, ())
+            ], final_markers=('Показано', 'Готово', 'не найдены'))  # первая страница материалов
+        self._remaining = len(self.users)
+
+    def send_step(self, user):
+        with user.lock:
+            if user.done:
+                return
+            text, attachments = user.steps[user.step]
+            user.sent_at = time.monotonic()
+            user.got_first_reply = False
+        self.fake.push_message(user.user_id, text, attachments)
+
+    def _finish(self, user, failed=False):
+        user.done = True
+        user.failed = failed
+        with self._remaining_lock:
+            self._remaining -= 1
+            if self._remaining == 0:
+                self._finished.set()
+
+    def on_reply(self, user_id, text):
+        user = self.users.get(user_id)
+        if user is None:
+            return
+        with user.lock:
+            if user.done or user.sent_at is None:
+                return
+            now = time.monotonic()
+            if not user.got_first_reply:
+                user.got_first_reply = True
+                with self._latency_lock:
+                    self.latencies.append(now - user.sent_at)
+
+            if 'Произошла ошибка' in text:
+                self._finish(user, failed=True)
+                return
+
+            last_step = user.step == len(user.steps) - 1
+            if last_step and user.final_markers:
+                # Педагог получает несколько сообщений - ждём итогового по странице
+                if not any(marker in text for marker in user.final_markers):
+                    return
+                with self._latency_lock:
+                    self.retrievals.append(now - user.sent_at)
+            if last_step:
+                self._finish(user)
+                return
+            user.step += 1
+        self.schedule(random.uniform(0, self.args.think), user)
+
+    # ----- запуск -----
+    def start_fake_vk(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FakeVkHandler)
+        server.daemon_threads = True
+        server.fake = self.fake
+        self.fake.url = f'http://127.0.0.1:{server.server_address[1]}'
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def start_bot(self, workdir):
+        env = dict(os.environ,
+                   VK_TOKEN='loadtest', VK_GROUP_ID='1', VK_API_URL=self.fake.url,
+                   PORT=str(self.args.web_port), PYTHONUNBUFFERED='1')
+        if self.args.callback:
+            env.update(VK_EVENTS_MODE='callback', VK_CALLBACK_SECRET=CALLBACK_SECRET)
+        log = open(os.path.join(workdir, 'bot_output.log'), 'w', encoding='utf-8')
+        return subprocess.Popen([sys.executable, BOT_PATH], cwd=workdir, env=env,
+                                stdout=log, stderr=subprocess.STDOUT)
+
+    def run(self):
+        workdir = self.args.workdir or tempfile.mkdtemp(prefix='vk-bot-loadtest-')
+        os.makedirs(workdir, exist_ok=True)
+        if os.listdir(workdir):
+            # База прошлого запуска исказила бы отчёт, а сохранённый ts - сам опрос
+            sys.exit(f"❌ Рабочая папка {workdir} не пуста: укажите новую или пустую папку")
+        server = self.start_fake_vk()
+        bot = self.start_bot(workdir)
+        print(f"🧪 Поддельный VK: {self.fake.url}, рабочая папка бота: {workdir}")
+        try:
+            if self.args.callback:
+                self.fake.callback_url = f'http://127.0.0.1:{self.args.web_port}/callback'
+                self.fake.start_callback_senders()
+                connected = self.wait_ready(30)
+            else:
+                connected = self.fake.connected.wait(30)
+            if not connected:
+                print("❌ Бот не запустился за 30 секунд, см. bot_output.log")
+                return None
+
+            self.build_users()
+            threading.Thread(target=self._scheduler, daemon=True).start()
+            started = time.monotonic()
+            for user in self.users.values():
+                self.schedule(random.uniform(0, self.args.ramp), user)
+
+            self._finished.wait(self.args.timeout)
+            duration = time.monotonic() - started
+        finally:
+            self._finished.set()
+            bot.send_signal(signal.SIGTERM)
+            try:
+                bot.wait(30)
+            except subprocess.TimeoutExpired:
+                bot.kill()
+            server.shutdown()
+
+        return self.report(duration, os.path.join(workdir, 'bot_database.db'))
+
+    def wait_ready(self, timeout):
+        """Ожидание 200 от /ready бота"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{self.args.web_port}/ready', timeout=1):
+                    return True
+            except (urllib.error.URLError, OSError):
+                time.sleep(0.2)
+        return False
+
+    def report(self, duration, db_path):
+        try:
+            with sqlite3.connect(db_path) as conn:
+                submissions = conn.execute('SELECT COUNT(*) FROM submissions').fetchone()[0]
+        except sqlite3.Error:
+            submissions = 0
+
+        latencies = sorted(self.latencies)
+        retrievals = sorted(self.retrievals)
+        completed = sum(1 for user in self.users.values() if user.done and not user.failed)
+        failed = sum(1 for user in self.users.values() if user.failed)
+        messages = len(latencies)
+        return {
+            'parents': self.args.parents,
+            'teachers': self.args.teachers,
+            'duration_s': round(duration, 3),
+            'flows_completed': completed,
+            'flows_failed': failed,
+            'flows_timed_out': len(self.users) - completed - failed,
+            'messages_answered': messages,
+            'throughput_msg_per_s': round(messages / duration, 2) if duration else 0.0,
+            'reply_latency_ms': {
+                'p50': round(percentile(latencies, 50) * 1000, 1),
+                'p95': round(percentile(latencies, 95) * 1000, 1),
+                'p99': round(percentile(latencies, 99) * 1000, 1),
+                'max': round(latencies[-1] * 1000, 1) if latencies else 0.0
+            },
+            'teacher_retrieval_ms': {
+                'p50': round(percentile(retrievals, 50) * 1000, 1),
+                'p95': round(percentile(retrievals, 95) * 1000, 1)
+            },
+            'db_submissions': submissions,
+            'db_write_rate_per_s': round(submissions / duration, 2) if duration else 0.0,
+            'vk_calls': dict(sorted(self.fake.calls.items())),
+            'vk_injected_errors': self.fake.errors,
+            'callback_retries': self.fake.callback_retries
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест бота на поддельном VK')
+    parser.add_argument('--parents', type=int, default=500, help='число родителей')
+    parser.add_argument('--teachers', type=int, default=5, help='число педагогов')
+    parser.add_argument('--ramp', type=float, default=5.0, help='разгон: старт пользователей в течение N секунд')
+    parser.add_argument('--think', type=float, default=0.0, help='пауза пользователя между шагами, до N секунд')
+    parser.add_argument('--latency', type=float, default=0.02, help='задержка ответа API, секунды')
+    parser.add_argument('--jitter', type=float, default=0.01, help='случайная добавка к задержке, секунды')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ошибок messages.send/users.get')
+    parser.add_argument('--error-code', type=int, default=10, help='код внедряемой ошибки VK')
+    parser.add_argument('--timeout', type=float, default=300.0, help='максимальная длительность теста, секунды')
+    parser.add_argument('--password', default='050607', help='пароль педагога')
+    parser.add_argument('--web-port', type=int, default=5099, help='порт веб-сервера бота')
+    parser.add_argument('--workdir', help='рабочая папка бота (по умолчанию - временная)')
+    parser.add_argument('--callback', action='store_true', help='доставлять события через Callback API')
+    parser.add_argument('--json', action='store_true', help='вывести только JSON')
+    args = parser.parse_args()
+
+    result = LoadTest(args).run()
+    if result is None:
+        sys.exit(1)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+        return
+
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
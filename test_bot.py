@@ -0,0 +1,65 @@
+"""Регрессионные тесты бота.
+
+База создаётся во временной папке, VK API заменяется заглушкой из benchmarks.py:
+
+    python -m unittest test_bot
+"""
+import shutil
+import tempfile
+import unittest
+
+from benchmarks import load_bot
+
+workdir = None
+bot = None
+
+def setUpModule():
+    global workdir, bot
+    workdir = tempfile.mkdtemp(prefix='vk-bot-test-')
+    bot = load_bot(workdir)
+
+def tearDownModule():
+    bot.db_writer.stop()
+    bot.db.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+class SaveSubmissionTest(unittest.TestCase):
+    def group_count(self, group_name):
+        row = bot.db.fetchone('SELECT count FROM stats_by_group WHERE group_name = ?', (group_name,))
+        return row[0] if row else 0
+
+    def test_resend_with_changed_group_updates_row_and_stats(self):
+        args = dict(user_id=500, user_name='Тест', date='01.12.2025',
+                    child_name='Иван Иванов', video_attachment='video-1_500')
+        self.assertTrue(bot.save_submission(group_name='Земля', **args))
+        earth, vega = self.group_count('Земля'), self.group_count('Вега')
+
+        self.assertTrue(bot.save_submission(group_name='Вега', **args))
+
+        rows = bot.db.fetchall('SELECT group_name FROM submissions WHERE video_attachment = ?',
+                               ('video-1_500',))
+        self.assertEqual(rows, [('Вега',)])
+        self.assertEqual(self.group_count('Земля'), earth - 1)
+        self.assertEqual(self.group_count('Вега'), vega + 1)
+
+class ModeSelectionTest(unittest.TestCase):
+    user_id = 600
+    user_info = {'first_name': 'Тест', 'last_name': 'Тестов'}
+
+    def select_mode(self, text):
+        bot.set_user_setting(self.user_id, True)
+        with bot.state_lock:
+            bot.user_states[self.user_id] = {'state': bot.UserState.CHOOSE_MODE}
+        bot.handle_message(self.user_id, text, [], self.user_info)
+        with bot.state_lock:
+            state = bot.user_states.get(self.user_id, {}).get('state')
+        return state, bot.get_user_setting(self.user_id)
+
+    def test_bot_keyword_wins_over_messages_keyword(self):
+        self.assertEqual(self.select_mode('писать боту'), (bot.UserState.CHOOSE_ROLE, True))
+
+    def test_messages_keyword(self):
+        self.assertEqual(self.select_mode('хочу писать сообщения'), (None, False))
+
+if __name__ == '__main__':
+    unittest.main()